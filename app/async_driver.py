@@ -0,0 +1,47 @@
+# coding: utf8
+# Asynchronous app driver
+#
+# Serves the same app as ``heroku_driver.py`` but on top of gevent: blocking
+# network calls made while extracting content yield to other requests, so a
+# single process can hold hundreds of extractions in flight. CPU-bound parsing
+# is offloaded to gevent's native thread pool to keep the event loop responsive;
+# state it shares with greenlets is guarded by native locks (see ``locks.py``).
+# ePub chapters aren't parsed by a process pool here, since forking a
+# monkey-patched process isn't safe.
+
+from gevent import monkey; monkey.patch_all()
+
+import sys
+import logging
+
+from os import environ as ENV
+
+import gevent
+from gevent.pywsgi import WSGIServer
+
+SERVER_PORT = int(ENV['PORT']) # listening port (mandatory)
+APP_DEBUG   = int(ENV.get('APP_DEBUG', '0'))
+
+def _setup_logging():
+    """ Redirect stdout to the system log."""
+
+    logger = logging.getLogger()
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.NOTSET if APP_DEBUG else logging.INFO)
+
+def _cpu_executor(func, *args):
+    return gevent.get_hub().threadpool.apply(func, args)
+
+if __name__ == '__main__':
+
+    _setup_logging()
+
+    print 'ASYNC: server port {} dbg {}'.format(SERVER_PORT, APP_DEBUG)
+
+    import extractor; extractor.disable_process_pool()
+
+    import spritsit
+
+    spritsit.extractor.set_cpu_executor(_cpu_executor)
+
+    WSGIServer(('0.0.0.0', SERVER_PORT), spritsit.app).serve_forever()
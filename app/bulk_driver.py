@@ -0,0 +1,242 @@
+# coding: utf8
+# Bulk extraction driver
+#
+# Pre-warms the document cache for reading lists: extracts every URL listed in
+# a file (one per line, ``#`` starts a comment) with a pool of worker threads,
+# limiting concurrent requests to every host, and stores the documents in the
+# SQLite cache file the app reads (``doc_cache.disk_path`` in settings.json)
+# or in the one given with ``--store``. URLs already in the store are skipped.
+# With ``--processes``, hosts are split between worker processes, each running
+# its own thread pool. Throughput, failures and per-stage timings are reported
+# at the end.
+#
+#   python bulk_driver.py [-p PROCESSES] [-w WORKERS] [--per-host N]
+#                         [--store FILE] URLS_FILE
+
+import sys
+import time
+import zlib
+import logging
+import argparse
+import threading
+import urlparse
+import multiprocessing
+
+from os import path
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+from settings import settings
+from doccache import DocumentCache
+from extractor import extractor, start_process_pool, disable_process_pool, \
+        CleanDocument
+from metrics import STAGE_SECONDS
+
+#------------------------------------------------------------------------------
+
+# App logger
+log = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+
+def _setup_logging(verbose):
+    """ Redirect log to stderr, keeping stdout for the report."""
+
+    logger = logging.getLogger()
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    logger.setLevel(logging.INFO if verbose else logging.WARN)
+
+def _read_urls(filename):
+    fin = sys.stdin if filename == '-' else open(filename)
+
+    with fin:
+        urls = [line.split('#', 1)[0].strip() for line in fin]
+
+    return [url if url.startswith('http') else 'http://' + url
+            for url in urls if url]
+
+def _host(url):
+    return urlparse.urlsplit(url).netloc.lower()
+
+class HostLimiter(object):
+    """Per-host semaphores allowing at most ``limit`` concurrent holders."""
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._semaphores[host] = threading.Semaphore(
+                        self._limit)
+            return semaphore
+
+#------------------------------------------------------------------------------
+
+def _extract_one(url, limiter):
+    """Return result record for ``url``: its ``status`` is either ``'ok'``,
+    ``'cached'`` or ``'failed'``."""
+
+    result = dict(url=url, status='ok', words=0, error=None)
+
+    if extractor.cache.get(url) is not None:
+        result['status'] = 'cached'
+        return result
+
+    start = time.time()
+
+    try:
+        with limiter.get(_host(url)):
+            doc = extractor.extract(url, stale=False)
+
+        if doc.is_empty() and not getattr(doc, 'preprocess', None):
+            result.update(status='failed', error='No readable content')
+        else:
+            result['words'] = getattr(doc, 'word_count', 0)
+
+    except Exception as err:
+        result.update(status='failed', error=str(err) or repr(err))
+
+    result['seconds'] = time.time() - start
+
+    log.info('%s %s', result['status'], url)
+
+    return result
+
+def _run_shard(task):
+    """Extract ``urls`` with a thread pool, return results and the totals of
+    stage timings."""
+
+    urls, store, workers, per_host = task
+
+    extractor.set_cache(DocumentCache(CleanDocument.from_bytes,
+        memory_size=settings.doc_cache['memory_size'],
+        ttl=settings.doc_cache['ttl'],
+        disk_path=store,
+        disk_items=max(settings.doc_cache['disk_items'], len(urls)),
+        max_stale=settings.doc_cache['max_stale']))
+
+    limiter = HostLimiter(per_host)
+
+    pool = ThreadPool(max(min(workers, len(urls)), 1))
+
+    try:
+        results = pool.map(lambda url: _extract_one(url, limiter), urls)
+    finally:
+        pool.terminate()
+
+    return results, STAGE_SECONDS.totals()
+
+def _shard(urls, count):
+    """Split ``urls`` into ``count`` lists keeping every host in one list."""
+
+    shards = [[] for _ in range(count)]
+
+    for url in urls:
+        shards[zlib.crc32(_host(url)) % count].append(url)
+
+    return [shard for shard in shards if shard]
+
+def run(urls, store, processes=0, workers=8, per_host=2):
+    """Return ``(results, stages)`` of extracting ``urls`` into ``store``."""
+
+    if processes <= 1:
+        # Fork ePub parsing workers before the thread pool is started
+        start_process_pool()
+        return _run_shard((urls, store, workers, per_host))
+
+    # Daemonic pool processes can't have children, so they parse ePub
+    # chapters themselves
+    pool = multiprocessing.Pool(processes, initializer=disable_process_pool)
+
+    try:
+        shards = pool.map(_run_shard, [(shard, store, workers, per_host)
+            for shard in _shard(urls, processes)])
+    finally:
+        pool.terminate()
+
+    results, stages = [], defaultdict(lambda: (0, 0.0))
+
+    for shard_results, shard_stages in shards:
+        results.extend(shard_results)
+        for labels, (count, total) in shard_stages.items():
+            stages[labels] = (stages[labels][0] + count,
+                    stages[labels][1] + total)
+
+    return results, dict(stages)
+
+#------------------------------------------------------------------------------
+
+def report(results, stages, elapsed, out=sys.stdout):
+
+    status = defaultdict(int)
+    for result in results:
+        status[result['status']] += 1
+
+    words = sum(result['words'] for result in results)
+
+    out.write('URLs: %d, extracted: %d, cached: %d, failed: %d\n' % (
+        len(results), status['ok'], status['cached'], status['failed']))
+
+    out.write('Elapsed: %.1f s, %.2f URLs/s, %.0f words/s\n' % (elapsed,
+        status['ok'] / elapsed if elapsed else 0,
+        words / elapsed if elapsed else 0))
+
+    if stages:
+        out.write('\n%-20s %8s %10s %10s\n' % ('stage', 'count', 'total, s',
+            'mean, ms'))
+
+        for labels, (count, total) in sorted(stages.items()):
+            out.write('%-20s %8d %10.2f %10.2f\n' % (dict(labels)['stage'],
+                count, total, 1000 * total / count if count else 0))
+
+    failures = [result for result in results if result['status'] == 'failed']
+
+    if failures:
+        out.write('\nFailures:\n')
+        for result in failures:
+            out.write('  %s: %s\n' % (result['url'], result['error']))
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Extract URLs listed in a file into the document store.')
+    parser.add_argument('urls', metavar='URLS_FILE',
+            help="file with a URL per line, '-' for stdin")
+    parser.add_argument('-p', '--processes', type=int, default=0,
+            help='worker processes (default: run in this one)')
+    parser.add_argument('-w', '--workers', type=int,
+            default=settings.extract_workers, help='threads per process')
+    parser.add_argument('--per-host', type=int, default=2,
+            help='concurrent extractions per host')
+    parser.add_argument('--store', help='SQLite document store '
+            '(default: doc_cache.disk_path of settings.json)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    _setup_logging(args.verbose)
+
+    if args.store:
+        store = path.abspath(args.store)
+    elif settings.doc_cache['disk_path']:
+        # Relative to the app folder, as the app resolves it
+        store = path.join(path.dirname(path.abspath(__file__)),
+                settings.doc_cache['disk_path'])
+    else:
+        parser.error('no document store given or configured')
+
+    urls = _read_urls(args.urls)
+
+    start = time.time()
+
+    results, stages = run(urls, store, args.processes, args.workers,
+            args.per_host)
+
+    report(results, stages, time.time() - start)
+
+    return 1 if any(result['status'] == 'failed' for result in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+"""Two-tier cache of extracted documents keyed by normalized URL.
+
+The first tier is an in-process :class:`lrucache.LRUCache` holding document
+objects; the second, optional tier is a SQLite file shared by all worker
+processes on the host, holding documents in a binary format (see
+:mod:`docpack`).
+
+Expired documents are kept for a while longer, so that they may be
+revalidated against their source instead of being extracted anew.
+"""
+
+import os
+import time
+import logging
+import threading
+import urlparse
+
+from lrucache import LRUCache
+
+try:
+    import sqlite3
+except ImportError: # e.g., Google App Engine
+    sqlite3 = None
+
+#------------------------------------------------------------------------------
+
+# App logger
+log = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def normalize_url(url):
+    """Return canonical form of ``url`` suitable for a cache key.
+
+    Example::
+
+        >>> normalize_url('HTTP://Example.COM:80/a?b=1#frag')
+        'http://example.com/a?b=1'
+        >>> normalize_url('https://example.com')
+        'https://example.com/'
+
+    """
+    parts = urlparse.urlsplit(url.strip())
+
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+
+    if parts.port and parts.port == _DEFAULT_PORTS.get(scheme):
+        netloc = netloc.rsplit(':', 1)[0]
+
+    return urlparse.urlunsplit(
+            (scheme, netloc, parts.path or '/', parts.query, ''))
+
+#------------------------------------------------------------------------------
+
+def _document_size(doc):
+    return doc.size() + 1
+
+class SqliteStore(object):
+    """Persistent document store in a SQLite database at ``filename``.
+
+    Rows older than ``ttl`` seconds are stale, they're ignored once they
+    expired more than ``max_stale`` seconds ago. The least recently accessed
+    rows are evicted when there are more than ``max_items`` of them. Access
+    time is kept to ``access_granularity`` seconds, so that most reads don't
+    write.
+    """
+
+    _SCHEMA = '''CREATE TABLE IF NOT EXISTS documents (
+        key TEXT PRIMARY KEY,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL,
+        data BLOB NOT NULL)'''
+
+    def __init__(self, filename, ttl=None, max_items=4096, max_stale=0,
+            access_granularity=60):
+        self._filename = filename
+        self._ttl = ttl
+        self._max_stale = max_stale
+        self._max_items = max_items
+        self._access_granularity = access_granularity
+        self._local = threading.local()
+
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        with self._connect() as conn:
+            conn.execute(SqliteStore._SCHEMA)
+
+    def get(self, key):
+        data, staleness = self.lookup(key)
+
+        return None if staleness else data
+
+    def lookup(self, key):
+        """Return ``(data, staleness)`` for ``key`` as
+        :meth:`lrucache.LRUCache.lookup` does.
+        """
+        row = self._connect().execute(
+                'SELECT created, accessed, data FROM documents WHERE key = ?',
+                (key,)).fetchone()
+
+        if row is None:
+            return None, None
+
+        created, accessed, data = row
+
+        now = time.time()
+        staleness = 0
+
+        if self._ttl is not None:
+            staleness = max(now - created - self._ttl, 0)
+            if staleness > self._max_stale:
+                return None, None
+
+        if now - accessed >= self._access_granularity:
+            with self._connect() as conn:
+                conn.execute('UPDATE documents SET accessed = ? '
+                        'WHERE key = ?', (now, key))
+
+        return str(data), staleness # blobs are read as buffers
+
+    def put(self, key, data):
+        now = time.time()
+
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO documents '
+                    '(key, created, accessed, data) VALUES (?, ?, ?, ?)',
+                    (key, now, now, sqlite3.Binary(data)))
+            conn.execute('DELETE FROM documents WHERE key IN ('
+                    'SELECT key FROM documents ORDER BY accessed DESC '
+                    'LIMIT -1 OFFSET ?)', (self._max_items,))
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self._filename, timeout=10)
+            conn.text_factory = str
+            self._local.conn = conn
+
+        return conn
+
+#------------------------------------------------------------------------------
+
+class DocumentCache(object):
+    """Cache of documents in front of the extractor.
+
+    ``factory`` rebuilds a document from the data its ``to_bytes()`` returned
+    for the persistent tier (e.g., ``CleanDocument.from_bytes``). Expired
+    documents are kept for another ``max_stale`` seconds for :meth:`lookup`.
+    """
+
+    def __init__(self, factory, memory_size, ttl=None, disk_path=None,
+            disk_items=4096, max_stale=0):
+        self._factory = factory
+        self._memory = LRUCache(memory_size, ttl, sizeof=_document_size,
+                max_stale=max_stale)
+        self._disk = None
+        self._lock = threading.Lock()
+        self._disk_hits = self._disk_misses = self._disk_errors = 0
+
+        if disk_path and sqlite3 is None:
+            log.warn('sqlite3 is unavailable, document disk cache disabled.')
+        elif disk_path:
+            try:
+                self._disk = SqliteStore(disk_path, ttl, disk_items,
+                        max_stale)
+                log.info('Document disk cache: %s', disk_path)
+            except Exception as err:
+                log.error('Cannot open document disk cache %s: %r',
+                        disk_path, err)
+
+    def get(self, url):
+        """Return fresh cached document for ``url`` or ``None``.
+        """
+        doc, staleness = self.lookup(url)
+
+        return None if staleness else doc
+
+    def lookup(self, url):
+        """Return ``(doc, staleness)`` for ``url``, where ``staleness`` is
+        ``0`` if the document is fresh or else the seconds since it expired,
+        or ``(None, None)`` if there's no such document. The disk tier is
+        looked up unless memory has a fresh document.
+        """
+        key = normalize_url(url)
+
+        doc, staleness = self._memory.lookup(key)
+
+        if staleness == 0 or self._disk is None:
+            return doc, staleness
+
+        data, disk_staleness = self._disk_call('lookup', key) or (None, None)
+
+        with self._lock:
+            if disk_staleness != 0:
+                self._disk_misses += 1
+            else:
+                self._disk_hits += 1
+
+        if data is None or (staleness is not None and
+                staleness <= disk_staleness):
+            return doc, staleness
+
+        try:
+            disk_doc = self._factory(data)
+        except ValueError as err: # e.g., stored in an unknown format
+            log.error('Cannot load cached document %s: %r', key, err)
+            with self._lock:
+                self._disk_errors += 1
+            return doc, staleness
+
+        # Stale documents would look fresh in memory, they're put back once
+        # revalidated
+        if not disk_staleness:
+            self._memory.put(key, disk_doc)
+
+        return disk_doc, disk_staleness
+
+    def get_shared(self, url):
+        """Return fresh document for ``url`` put by another process (i.e.,
+        in the disk tier) or ``None``, not counting the lookup in stats: it
+        rechecks a miss that's counted already.
+        """
+        if self._disk is None:
+            return None
+
+        key = normalize_url(url)
+
+        data = self._disk_call('get', key)
+
+        if data is None:
+            return None
+
+        try:
+            doc = self._factory(data)
+        except ValueError as err:
+            log.error('Cannot load cached document %s: %r', key, err)
+            with self._lock:
+                self._disk_errors += 1
+            return None
+
+        self._memory.put(key, doc)
+
+        return doc
+
+    def put(self, url, doc):
+        key = normalize_url(url)
+
+        self._memory.put(key, doc)
+
+        if self._disk is not None:
+            self._disk_call('put', key, doc.to_bytes())
+
+    def stats(self):
+        """Return hit/miss counters of both tiers."""
+        stats = dict(memory=self._memory.stats())
+
+        if self._disk is not None:
+            with self._lock:
+                stats['disk'] = dict(hits=self._disk_hits,
+                        misses=self._disk_misses, errors=self._disk_errors)
+
+        return stats
+
+    def _disk_call(self, method, *args):
+        try:
+            return getattr(self._disk, method)(*args)
+        except Exception as err:
+            log.error('Document disk cache %s failed: %r', method, err)
+            with self._lock:
+                self._disk_errors += 1
+
+if __name__ == "__main__":
+    import doctest; doctest.testmod()
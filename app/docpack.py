@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+"""Compact binary format of readable documents.
+
+Documents are cached on disk and passed between processes in this format
+rather than as JSON. The metadata fields come first, in a fixed order. Any
+other attributes follow as a small JSON blob, then tables of paragraph
+offsets and word counts and the text content, which is encoded to UTF-8 just
+once. Reading the metadata doesn't decode the content, paragraphs can be
+decoded a range at a time and located by words without decoding any.
+
+Layout, little-endian::
+
+    header      'SPD', version: u8, extras size: u32, paragraph count: u32
+    fields      strings as size: u32 + UTF-8 (size 0xffffffff for None),
+                integers as i64 (-2**63 for None), see FIELDS
+    extras      JSON object of other attributes (empty if there are none)
+    offsets     u32 byte offset of every paragraph in content
+    words       u32 word count of every paragraph (0xffffffff if unknown),
+                since version 2
+    content     UTF-8 paragraphs separated by newlines
+
+A document without content has paragraph count 0xffffffff.
+
+Example::
+
+    >>> data = pack(dict(url=u'http://a/', title=u'Hi', word_count=3),
+    ...         dict(excerpt=u'x'), u'One two\\nthree', [2, 1])
+    >>> record = PackedDocument(data)
+    >>> record.title, record.word_count, record.lang, record.extras
+    (u'Hi', 3, None, {u'excerpt': u'x'})
+    >>> record.paragraph_count, record.get_paragraphs(1)
+    (2, [u'three'])
+    >>> record.word_counts == array('I', [2, 1])
+    True
+    >>> record.content
+    u'One two\\nthree'
+
+"""
+
+import sys
+import json
+import struct
+
+from array import array
+
+#------------------------------------------------------------------------------
+
+# Format version, bump it on any layout change
+VERSION = 2
+
+# Older versions still read
+_READABLE_VERSIONS = frozenset([1, VERSION])
+
+# Metadata fields in their packed order
+FIELDS = ('url', 'title', 'author', 'lang', 'direction', 'url_type',
+        'word_count')
+
+_INTEGER_FIELDS = frozenset(['word_count'])
+
+_MAGIC = 'SPD'
+
+_HEADER = struct.Struct('<3sBII')
+_SIZE = struct.Struct('<I')
+_INTEGER = struct.Struct('<q')
+
+_NO_SIZE = 0xffffffff
+_NO_INTEGER = -2 ** 63
+
+def _pack_field(name, value):
+
+    if name in _INTEGER_FIELDS:
+        return _INTEGER.pack(_NO_INTEGER if value is None else value)
+
+    if value is None:
+        return _SIZE.pack(_NO_SIZE)
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    return _SIZE.pack(len(value)) + value
+
+def _unpack_field(name, data, pos):
+    """Return ``(value, pos)`` of field ``name`` at ``pos`` of ``data`` and
+    the position following it."""
+
+    if name in _INTEGER_FIELDS:
+        value, = _INTEGER.unpack_from(data, pos)
+        pos += _INTEGER.size
+        return (None if value == _NO_INTEGER else value), pos
+
+    size, = _SIZE.unpack_from(data, pos)
+    pos += _SIZE.size
+
+    if size == _NO_SIZE:
+        return None, pos
+
+    return data[pos:pos + size].decode('utf-8'), pos + size
+
+def _pack_table(values):
+    table = array('I', values)
+
+    if sys.byteorder == 'big':
+        table.byteswap()
+
+    return table.tostring()
+
+def pack(fields, extras=None, content=None, word_counts=None):
+    """Return document packed from ``fields`` dict (keys of :data:`FIELDS`),
+    ``extras`` dict of other JSON serializable attributes, text ``content``
+    of newline separated paragraphs and ``word_counts`` of the paragraphs,
+    if they're known.
+    """
+    chunks = [_pack_field(name, fields.get(name)) for name in FIELDS]
+
+    extras = json.dumps(extras, separators=(',', ':')) if extras else ''
+    chunks.append(extras)
+
+    count = _NO_SIZE
+
+    if content is not None:
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+
+        # Newline bytes never occur inside UTF-8 multibyte sequences
+        offsets, offset = [], 0
+        for parag in content.split('\n'):
+            offsets.append(offset)
+            offset += len(parag) + 1
+
+        count = len(offsets)
+
+        if word_counts is None:
+            word_counts = [_NO_SIZE] * count
+        elif len(word_counts) != count:
+            raise ValueError('Word counts of %d paragraphs for %d' %
+                    (len(word_counts), count))
+
+        chunks.append(_pack_table(offsets))
+        chunks.append(_pack_table(word_counts))
+        chunks.append(content)
+
+    header = _HEADER.pack(_MAGIC, VERSION, len(extras), count)
+
+    return header + ''.join(chunks)
+
+class PackedDocument(object):
+    """Read-only view of document ``data`` made by :func:`pack`: fields of
+    :data:`FIELDS` and ``extras`` are read up front, content is decoded only
+    when it's asked for. Raises :exc:`ValueError` on unknown data.
+    """
+
+    __slots__ = FIELDS + ('extras', '_data', '_count', '_offsets_pos',
+            '_words_pos', '_content_pos')
+
+    def __init__(self, data):
+        if len(data) < _HEADER.size:
+            raise ValueError('Packed document is truncated')
+
+        magic, version, extras_size, count = _HEADER.unpack_from(data)
+
+        if magic != _MAGIC:
+            raise ValueError('Not a packed document')
+
+        if version not in _READABLE_VERSIONS:
+            raise ValueError('Unsupported packed document version %d' %
+                    version)
+
+        pos = _HEADER.size
+
+        for name in FIELDS:
+            value, pos = _unpack_field(name, data, pos)
+            setattr(self, name, value)
+
+        self.extras = {}
+        if extras_size:
+            self.extras = json.loads(data[pos:pos + extras_size])
+
+        pos += extras_size
+
+        self._data = data
+        self._count = count
+        self._offsets_pos = pos
+        self._words_pos = None
+
+        if count != _NO_SIZE:
+            pos += count * _SIZE.size
+
+            if version >= 2:
+                self._words_pos = pos
+                pos += count * _SIZE.size
+
+        self._content_pos = pos
+
+    @property
+    def size(self):
+        """Size of packed data in bytes."""
+        return len(self._data)
+
+    @property
+    def content_size(self):
+        """Size of UTF-8 encoded content in bytes."""
+        return len(self._data) - self._content_pos
+
+    @property
+    def paragraph_count(self):
+        return 0 if self._count == _NO_SIZE else self._count
+
+    @property
+    def content(self):
+        """Decoded text content or ``None`` if there's none."""
+        if self._count == _NO_SIZE:
+            return None
+
+        return self._data[self._content_pos:].decode('utf-8')
+
+    @property
+    def word_counts(self):
+        """Array of word counts of paragraphs or ``None`` if they're unknown.
+        """
+        if self._words_pos is None or not self._count:
+            return None
+
+        table = array('I')
+        table.fromstring(self._data[self._words_pos:self._content_pos])
+
+        if sys.byteorder == 'big':
+            table.byteswap()
+
+        if table[0] == _NO_SIZE:
+            return None
+
+        return table
+
+    def get_paragraphs(self, first=0, last=None):
+        """Return list of paragraphs from ``first`` up to ``last`` (to the end
+        if ``None``), decoding only these ones.
+        """
+        count = self.paragraph_count
+        last = count if last is None else min(last, count)
+
+        if first >= last:
+            return []
+
+        start = self._content_pos + self._get_offset(first)
+
+        if last < count:
+            end = self._content_pos + self._get_offset(last) - 1
+        else:
+            end = len(self._data)
+
+        return self._data[start:end].decode('utf-8').split(u'\n')
+
+    def _get_offset(self, index):
+        offset, = _SIZE.unpack_from(self._data,
+                self._offsets_pos + index * _SIZE.size)
+        return offset
+
+if __name__ == "__main__":
+    import doctest; doctest.testmod()
@@ -3,23 +3,50 @@
 """ Text extraction methods.
 """
 import re
+import sys
+import copy
+import time
+import codecs
 import json
+import Queue
+import bisect
 import urllib
 import urllib2
 import logging
+import threading
+
+from os import path
+from array import array
 
 import lazygen
+import docpack
 from settings import settings
+from doccache import DocumentCache, normalize_url
+from singleflight import SingleFlight
+from refresher import Refresher
+from fetcher import Fetcher, RangeReader, supports_ranges
+from metrics import registry, STAGE_SECONDS, LOCAL_FALLBACKS, REVALIDATIONS
 
 import fixpath
 
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+
 from lxml import html, etree
 from readability import readability
 from ebooklib import epub, ITEM_DOCUMENT
 
-import pyphen
+import pdftext
+import tokenizer
+import hyphenation
 from guess_language import guess_language
 
+try:
+    import chardet
+except ImportError:
+    chardet = None
+
 #------------------------------------------------------------------------------
 
 # App logger
@@ -31,68 +58,107 @@ _regex = {
     'paragraphs': re.compile(ur'\n\s*\n\s*|\n\s\s+', flags=re.UNICODE),
     'spaces': re.compile(ur'\s+', flags=re.UNICODE),
     'longdash': re.compile(ur'\-{2,}', flags=re.UNICODE),
+    'charset': re.compile(r'<meta[^>]+charset=["\']?([\w\-]+)', flags=re.I),
+    'lang': re.compile(r'^\s*([a-z]{2,3})(?:[\-_][a-z0-9]+)*\s*$', flags=re.I),
 }
 
-XPATH_ALL_NODES = etree.XPath('//*')
+
+#------------------------------------------------------------------------------
+
+PAGE_WORDS      = 'words'
+PAGE_PARAGRAPHS = 'paragraphs'
 
 #------------------------------------------------------------------------------
 
 LANG_FALLBACK = 'en'
 LANG_UNKNOWN  = guess_language.UNKNOWN
-HYPH_FALLBACK = pyphen.Pyphen(lang=LANG_FALLBACK)
+HYPH_FALLBACK = hyphenation.get_hyphenator(LANG_FALLBACK)
 
-class LangGuess:
-    """ Try guessing document language with ``guess_language``.
+def _normalize_lang(lang):
+    """ Return primary subtag of declared language tag ``lang`` (e.g., 'en'
+    for 'en-US') or ``None`` if it isn't a single valid tag.
     """
+    match = _regex['lang'].match(lang or '')
 
-    def __init__(self):
-        self._lang   = None
-        self._corpus = None
-        self._wcount = 0
-        self._pyphen = None
+    return match.group(1).lower() if match else None
 
-    def get_lang(self):
+class LangGuess(object):
+    """ Guess document language with ``guess_language``, unless it's given.
 
-        lang = self._guess_lang()
+    The language is guessed once, on the first ``lang_guess.sample_size``
+    characters of text: ``guess_language`` is slow on anything longer. Shorter
+    documents are guessed on all their text by :meth:`decide` at their end.
+    The guess then holds for the rest of the document, e.g., for all chapters
+    of ePub book.
+    """
 
-        return lang if lang else LANG_FALLBACK
+    def __init__(self, lang=None):
+        self._lang   = lang
+        self._done   = bool(lang)
+        self._sample = []
+        self._size   = 0
 
-    def update_corpus(self, words, wordcount):
+    def get_lang(self):
+        """ Return the language decided so far, or the fallback one.
+        """
+        return self._lang if self._lang else LANG_FALLBACK
 
-        if (wordcount > self._wcount) and (wordcount <= 256 or
-               self._wcount <= 3):
-            self._corpus, self._wcount = words, wordcount
+    def is_decided(self):
+        return self._done
 
-    def _guess_lang(self, wordcontext=None):
+    def set_hint(self, lang):
+        """ Take language declared by the content (e.g., in ``<html lang>``
+        or ``Content-Language``) unless it's decided already.
+        """
+        lang = _normalize_lang(lang)
 
-        if not self._lang:
-            words = self._corpus
+        if lang and not self._done:
+            log.info('Declared lang: %s', lang)
+            self._lang, self._done, self._sample = lang, True, []
 
-            if not words:
-                words = wordcontext
+    def update_corpus(self, text):
 
-            lang = guess_language.guessLanguage(words)
+        if self._done:
+            return
 
-            log.info('Guessed lang: %s', lang)
+        # A long paragraph is cut, so that the sample doesn't overshoot
+        sample_size = settings.lang_guess['sample_size']
 
-            if self._lang == LANG_UNKNOWN:
-                lang = None
+        self._sample.append(text[:sample_size - self._size])
+        self._size += len(self._sample[-1])
 
-            self._lang = lang
+        if self._size >= sample_size:
+            self._run_guess()
 
-        return self._lang
+    def _run_guess(self):
 
-    def get_hyphenator(self, wordcontext):
+        with STAGE_SECONDS.time(stage='lang_guess'):
+            lang = guess_language.guessLanguage(u' '.join(self._sample))
 
-        if self._pyphen:
-            return self._pyphen
+        log.info('Guessed lang: %s', lang)
 
-        try:
-            lang = self._guess_lang(wordcontext)
+        self._lang = lang if lang != LANG_UNKNOWN else None
+        self._done, self._sample = True, []
+
+    def decide(self):
+        """ Decide the language on the text sampled so far, at the end of
+        document.
+        """
+        if self._done:
+            return
 
-            self._pyphen = pyphen.Pyphen(lang=lang)
+        if self._sample:
+            self._run_guess()
+        else:
+            self._done = True
+
+    def get_hyphenator(self):
+        """ Return hyphenator of the language guessed so far.
+        """
+        lang = self.get_lang()
 
-            return self._pyphen
+        try:
+            return hyphenation.get_hyphenator(lang)
 
         except Exception as err:
             log.error("Couldn't create hyphenator for %r: %r", lang, err)
@@ -112,11 +178,189 @@ _TAG_PADDING = {
     'h4'    : _PARAG_SEPARATOR,
 }
 
-class CleanDocument:
+def _generate_raw_paragraphs(root):
+    """ Generate raw text paragraphs of ``root`` element tree in a single
+    walk, without building the whole text in memory. The text is the same
+    as of the whole tree serialized with every element's tail padded.
+    """
+    pieces = []
+
+    def flush():
+        text = u''.join(pieces)
+        del pieces[:]
+
+        for parag in _regex['paragraphs'].split(text):
+            if parag.strip():
+                yield parag
+
+    def add_tails(node):
+        # Comments and processing instructions contribute their tails only,
+        # they aren't walked over by all lxml versions
+        while node is not None and not isinstance(node.tag, basestring):
+            if node.tail:
+                pieces.append(node.tail)
+            node = node.getnext()
+
+    for event, node in etree.iterwalk(root, events=('start', 'end')):
+
+        if not isinstance(node.tag, basestring):
+            continue
+
+        if event == 'start':
+            if node.text:
+                pieces.append(node.text)
+            add_tails(node[0] if len(node) else None)
+            continue
+
+        if node.tail:
+            pieces.append(node.tail)
+
+        # Add padding so that text in adjacent tags wouldn't stick
+        # together. E.g., "<p>Hello<br/>World!</p>" should look as
+        # "Hello World!" and not as "HelloWorld!". The padding follows
+        # the tail, so "<em>un</em>believable" stays a single word.
+        padding = _TAG_PADDING.get(node.tag.lower(), ' ')
+
+        if padding == _PARAG_SEPARATOR:
+            for parag in flush():
+                yield parag
+        else:
+            pieces.append(padding)
+
+        add_tails(node.getnext())
+
+    for parag in flush():
+        yield parag
+
+#------------------------------------------------------------------------------
+
+# Subtrees dropped while parsing raw html, they're useless for reading
+_STRIP_TAGS = frozenset(['script', 'style', 'svg'])
+
+# Bytes to look for charset declaration in, as browsers do
+_SNIFF_SIZE = 1024
+
+# Undeclared charset that isn't UTF-8 is what chardet says if it's confident,
+# or else the legacy default of browsers
+_DETECT_MIN_CONFIDENCE = 0.9
+_LEGACY_CHARSET = 'windows-1252'
+
+def _parse_html_stream(istream, charset=None, max_size=None,
+        chunk_size=16384):
+    """ Parse html from ``istream`` as it's being read, stripping script,
+    style and svg subtrees on the way. Input beyond ``max_size`` bytes is
+    ignored. Return ``(html, lang)``: the html of stripped document as
+    unicode and the language declared in its ``<html lang>``, if any.
+    """
+    # The first chunk must be large enough to find <meta> charset in
+    data = istream.read(max(chunk_size, _SNIFF_SIZE))
+
+    # Unless given in http headers, take the charset declared in <meta>,
+    # or else the one the first chunk looks like
+    charset = (_lookup_charset(charset) or _sniff_charset(data) or
+            _detect_charset(data))
+
+    # Decode here rather than in libxml, so that invalid bytes are replaced
+    decoder = codecs.getincrementaldecoder(charset)('replace')
+
+    parser = etree.HTMLPullParser(events=('end',), remove_comments=True)
+
+    stripped = []
+    size = 0
+
+    while data:
+        if max_size is not None and size + len(data) > max_size:
+            log.warn('Html exceeds %d bytes, ignoring the rest.', max_size)
+            parser.feed(decoder.decode(data[:max_size - size]))
+            if hasattr(istream, 'close'):
+                istream.close()
+            break
+
+        size += len(data)
+
+        parser.feed(decoder.decode(data))
+
+        for _, elem in parser.read_events():
+            if isinstance(elem.tag, basestring) and elem.tag in _STRIP_TAGS:
+                # Free the contents now, the tail may be still growing
+                elem.text = None
+                del elem[:]
+                stripped.append(elem)
+
+        data = istream.read(chunk_size)
+
+    parser.feed(decoder.decode('', final=True))
+
+    try:
+        root = parser.close()
+    except etree.XMLSyntaxError as err: # e.g., no content at all
+        log.warn('Cannot parse html: %s', err)
+        return u'', None
+
+    for elem in stripped:
+        _drop_element(elem)
+
+    lang = root.get('lang') or root.get('xml:lang')
+
+    return html.tostring(root, encoding='unicode'), lang
+
+def _sniff_charset(data):
+    """ Return valid charset declared in html head ``data`` or ``None``."""
+    match = _regex['charset'].search(data)
+
+    return _lookup_charset(match.group(1)) if match else None
+
+def _detect_charset(data):
+    """ Return charset of html head ``data`` declaring none: UTF-8 if it's
+    valid UTF-8, or else the one guessed by ``chardet``.
+    """
+    try:
+        # Incremental, since a character may be cut at the end of data
+        codecs.getincrementaldecoder('utf-8')().decode(data)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    if chardet is None:
+        return _LEGACY_CHARSET
+
+    with STAGE_SECONDS.time(stage='charset_detect'):
+        guess = chardet.detect(data)
+
+    log.info('Detected charset: %r', guess)
+
+    if guess.get('confidence') < _DETECT_MIN_CONFIDENCE:
+        return _LEGACY_CHARSET
+
+    return _lookup_charset(guess.get('encoding')) or _LEGACY_CHARSET
+
+def _lookup_charset(name):
+    try:
+        return codecs.lookup(name).name if name else None
+    except LookupError:
+        return None
+
+def _drop_element(elem):
+    """ Remove ``elem`` from the tree, keeping its tail text."""
+    parent = elem.getparent()
+
+    if parent is None:
+        return
+
+    if elem.tail:
+        previous = elem.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + elem.tail
+        else:
+            parent.text = (parent.text or '') + elem.tail
+
+    parent.remove(elem)
+
+class CleanDocument(object):
     """ Readable document fetched from ``source_url``.
     """
 
-    def __init__(self, source_url, url_type=None):
+    def __init__(self, source_url, url_type=None, lang_hint=None):
         self.url = source_url
         self.title = None
         self.content = []
@@ -124,16 +368,77 @@ class CleanDocument:
         self.lang = None
         self.direction = None
         self.url_type = url_type
-        self._lang = LangGuess()
+        self._lang = LangGuess(lang_hint)
         self._error = False
+        self._stale = False
+        self._index = None
+        self._validators = None
 
     @property
     def source_url(self):
         return self.url
 
+    @property
+    def validators(self):
+        """Cache validators of the source (e.g., its ``etag``), they're kept
+        with the document in cache but aren't part of its JSON.
+        """
+        return self._validators
+
+    @validators.setter
+    def validators(self, value):
+        self._validators = value
+
+    @property
+    def content(self):
+        packed = self._packed
+
+        if packed is not None: # decode content of unpacked document once
+            self._content = packed.content
+            self._packed = None
+
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content, self._packed, self._index = value, None, None
+
     def is_empty(self):
+        packed = self._packed
+
+        if packed is not None:
+            return self._error or not packed.content_size
+
         return self._error or (not self.content)
 
+    def size(self):
+        """Return approximate size of the document content, not decoding it
+        if the document was unpacked.
+        """
+        packed = self._packed
+
+        if packed is not None:
+            return packed.size
+
+        return len(self._content or '')
+
+    def is_stale(self):
+        """Return ``True`` if the document is served while being refreshed.
+        """
+        return self._stale
+
+    def stale_copy(self):
+        """Return shallow copy of the document marked as stale."""
+        doc = copy.copy(self)
+        doc._stale = True
+        return doc
+
+    def set_lang_hint(self, lang):
+        """Skip language guessing if content declares its language ``lang``
+        (ignored if ``None`` or invalid).
+        """
+        self._lang.set_hint(lang)
+
     @classmethod
     def from_json(cls, json_object):
         """Create a document instance from JSON dictionary.
@@ -147,16 +452,121 @@ class CleanDocument:
 
         return doc
 
-    def json_generator(self):
-        """Return generator that produces JSON strings.
+    def to_json(self):
+        """Return JSON dictionary of public document attributes.
         """
-        json_object = dict((k, v) for (k, v) in self.__dict__.iteritems()
+        json_object = self._get_metadata()
+
+        json_object['content'] = self.content
+
+        return json_object
+
+    def _get_metadata(self):
+        return dict((k, v) for (k, v) in self.__dict__.iteritems()
                 if not k.startswith('_'))
 
+    @classmethod
+    def from_bytes(cls, data):
+        """Create a document instance from :meth:`to_bytes` output, its
+        content is decoded on first access. JSON (as documents used to be
+        stored) is accepted too.
+        """
+        if data.startswith('{'):
+            return cls.from_json(json.loads(data))
+
+        packed = docpack.PackedDocument(data)
+
+        doc = cls(packed.url)
+
+        for name in docpack.FIELDS:
+            value = getattr(packed, name)
+            if value is not None:
+                setattr(doc, name, value)
+
+        doc._error = packed.extras.get('error', '').lower() == 'true'
+
+        for key, value in packed.extras.iteritems():
+            setattr(doc, key, value)
+
+        # Documents without content keep the empty one they're created with
+        if packed.paragraph_count:
+            doc._packed = packed
+
+        return doc
+
+    def to_bytes(self):
+        """Return the document in compact binary format of :mod:`docpack`.
+        """
+        extras = self.to_json()
+
+        content = extras.pop('content', None)
+        if not isinstance(content, basestring): # e.g., nothing extracted
+            content = None
+
+        fields = dict((name, extras.pop(name, None))
+                for name in docpack.FIELDS)
+
+        if self._validators:
+            extras['validators'] = self._validators
+
+        word_counts = None
+
+        if isinstance(content, unicode):
+            # Pages of unpacked document are found without tokenizing it
+            parags, words, total_words = self._get_index()[:3]
+
+            word_counts = [0] * (content.count(u'\n') + 1)
+            for n, i in enumerate(parags):
+                end = words[n + 1] if n + 1 < len(words) else total_words
+                word_counts[i] = end - words[n]
+
+        return docpack.pack(fields, extras, content, word_counts)
+
+    def json_generator(self, tokens=False):
+        """Return generator that produces JSON strings; with ``tokens`` the
+        output also holds the result of :meth:`tokenize`.
+        """
+        json_object = self.to_json()
+
+        if tokens:
+            json_object['tokens'] = self.tokenize()
+
         return lazygen.json_generator(json_object)
 
-    def textify(self):
-        """ Transform html content to plain text.
+    def tokenize(self):
+        """ Return words of text content with their pivots, punctuation spans
+        and paragraph breaks as parallel arrays (see :mod:`tokenizer`).
+        """
+        content = self.content if isinstance(self.content, unicode) else u''
+
+        with STAGE_SECONDS.time(stage='tokenize'):
+            return tokenizer.tokenize(content.split(u'\n'),
+                    self.direction or 'ltr')
+
+    def textify(self, on_paragraph=None, final=True):
+        """ Transform html content to plain text, passing each paragraph to
+        ``on_paragraph`` (if given) as soon as it's cleaned. Unless it's
+        ``final``, more content of the document follows (e.g., ePub
+        chapters), and the language isn't decided on this part of it.
+        """
+        if not self.content:
+            return
+
+        clean = []
+
+        with STAGE_SECONDS.time(stage='textify'):
+            for parag in self.generate_paragraphs(final):
+                clean.append(parag)
+                if on_paragraph is not None:
+                    on_paragraph(parag)
+
+            self.content = '\n'.join(clean)
+
+    def generate_paragraphs(self, final=True):
+        """ Transform html content to plain text paragraphs, yielding each
+        one as soon as it's cleaned. Language, word count and direction are
+        set once the generator is exhausted, the language is decided then if
+        content is ``final``.
         """
         if not self.content:
             return
@@ -165,65 +575,182 @@ class CleanDocument:
 
         doc = html.fromstring(self.content)
 
-        # Add padding so that text in adjacent tags wouldn't stick
-        # together. E.g., "<p>Hello<br/>World!</p>" should look as
-        # "Hello World!" and not as "HelloWorld!".
-        for node in XPATH_ALL_NODES(doc):
-            tag = node.tag.lower()
+        word_count = 0
 
-            padding = _TAG_PADDING.get(tag, ' ')
+        # Paragraphs are held until there's a language to hyphenate them in
+        held = []
 
-            if node.tail:
-                node.tail = node.tail + padding
-            else:
-                node.tail = padding
+        for parag in _generate_raw_paragraphs(doc):
+            self._lang.update_corpus(parag)
 
-        txt = html.tostring(doc, method='text', encoding='unicode')
+            held.append(parag)
 
-        # Little cleanup surgery
-        paragraphs = _regex['paragraphs'].split(txt)
-        pcleaned, word_count = [], 0
+            if not self._lang.is_decided():
+                continue
 
-        for parag in paragraphs:
-            words   = _regex['spaces'].split(parag)
-            wclean  = []
+            for parag in held:
+                wclean = self._clean_paragraph(parag)
+                word_count += len(wclean)
+                yield ' '.join(wclean)
+
+            del held[:]
 
-            for word in words:
-                if word: # it must have been stripped by split()
-                    wclean.extend(self._clean_word(word, parag))
+        if final:
+            self._lang.decide()
 
-            parag_len = len(wclean)
+        for parag in held:
+            wclean = self._clean_paragraph(parag)
+            word_count += len(wclean)
+            yield ' '.join(wclean)
 
-            word_count += parag_len
+        self.word_count = word_count
+        self._set_lang()
 
-            self._lang.update_corpus(parag, parag_len)
+    def decide_lang(self):
+        """ Decide the language on all the text sampled, at the end of
+        document made of several parts.
+        """
+        self._lang.decide()
+        self._set_lang()
 
-            pcleaned.append(' '.join(wclean))
+    def _set_lang(self):
 
-        self.content = '\n'.join(pcleaned)
         self.lang = self._lang.get_lang()
-        self.word_count = word_count
 
         if self.lang in ['he', 'ar']:
             self.direction = 'rtl'
         elif not self.direction:
             self.direction = 'ltr'
 
-    def _clean_word(self, word, wordcontext):
+    def is_lang_decided(self):
+        return self._lang.is_decided()
+
+    def get_page(self, offset, limit, unit=PAGE_WORDS):
+        """ Return JSON dictionary of the document with content limited to
+        whole paragraphs covering ``limit`` words (or paragraphs, depending on
+        ``unit``) starting at ``offset``. Words are counted as by
+        :meth:`tokenize`. The ``page`` item describes the window: its first
+        word and paragraph, their counts and the ``next`` page offset.
+        """
+        parags, words, total_words = self._get_index()[:3]
+
+        if unit == PAGE_PARAGRAPHS:
+            first, last = offset, offset + limit
+        elif offset >= total_words:
+            first = last = len(words)
+        else:
+            first = max(bisect.bisect_right(words, offset) - 1, 0)
+            last = bisect.bisect_left(words, offset + limit)
+
+        first = min(first, len(words))
+        last = min(max(last, first), len(words))
+
+        def word_at(i):
+            return words[i] if i < len(words) else total_words
+
+        json_object = self._get_metadata()
+
+        if first < last:
+            json_object['content'] = self._get_text(parags[first],
+                    parags[last] if last < len(words) else None)
+        else:
+            json_object['content'] = u''
+
+        next_offset = None
+        if last < len(words):
+            next_offset = word_at(last) if unit == PAGE_WORDS else last
+
+        json_object['page'] = dict(unit=unit,
+                offset=word_at(first),
+                paragraph=first,
+                words=word_at(last) - word_at(first),
+                paragraphs=last - first,
+                total_words=total_words,
+                total_paragraphs=len(words),
+                next=next_offset)
+
+        return json_object
+
+    def _get_index(self):
+        """ Return positions of non-blank paragraphs in text content and of
+        their first words, total word count and character offsets of all the
+        paragraphs. Packed content isn't decoded if it has word counts, and
+        there are no character offsets then.
+        """
+        if self._index is None:
+            packed = self._packed
+            word_counts = packed.word_counts if packed is not None else None
+
+            if word_counts is not None:
+                parags, words, total_words = array('l'), array('l'), 0
+
+                for i, count in enumerate(word_counts):
+                    if count:
+                        parags.append(i)
+                        words.append(total_words)
+                        total_words += count
+
+                self._index = (parags, words, total_words, None)
+
+                return self._index
+
+            content = self.content if isinstance(self.content, unicode) else u''
+
+            paragraphs = content.split(u'\n')
+
+            starts = array('l', [0])
+            for parag in paragraphs:
+                starts.append(starts[-1] + len(parag) + 1)
+
+            offsets, total_words = tokenizer.word_offsets(paragraphs)
+
+            self._index = (array('l', [i for i, _ in offsets]),
+                    array('l', [word for _, word in offsets]),
+                    total_words, starts)
+
+        return self._index
+
+    def _get_text(self, first, last):
+        """ Return text of paragraphs from ``first`` up to ``last`` (to the
+        end if ``None``), decoding just them if content is packed.
+        """
+        packed = self._packed
+
+        if packed is not None:
+            return u'\n'.join(packed.get_paragraphs(first, last))
+
+        starts = self._index[3]
+
+        if starts is None: # indexed while packed
+            return u'\n'.join(self.content.split(u'\n')[first:last])
+
+        return self.content[starts[first]:
+                starts[last] - 1 if last is not None else None]
+
+    def _clean_paragraph(self, parag):
+        wclean = []
+
+        for word in _regex['spaces'].split(parag):
+            if word: # it must have been stripped by split()
+                wclean.extend(self._clean_word(word))
+
+        return wclean
+
+    def _clean_word(self, word):
         outlist = []
 
         dash_separated = _regex['longdash'].split(word)
 
         if len(dash_separated) >= 2:
             for subword in dash_separated:
-                outlist.extend(self._clean_word(subword, wordcontext))
+                outlist.extend(self._clean_word(subword))
                 outlist.append(u'\u2014') # mdash
             return outlist[:-1]
 
         if len(word) <= settings.max_word_len:
             return [word]
         else:
-            hyphenator = self._lang.get_hyphenator(wordcontext)
+            hyphenator = self._lang.get_hyphenator()
             return [hyphenator.multiwrap(word, settings.max_word_len)]
 
 #------------------------------------------------------------------------------
@@ -240,13 +767,24 @@ _CONTENT_TYPE_MAP = {
     'application/pdf'           : CONTENT_PDF,
 }
 
+# Response headers of cache validators and request headers to check them
+_VALIDATOR_HEADERS = {
+    'etag'          : ('ETag', 'If-None-Match'),
+    'last_modified' : ('Last-Modified', 'If-Modified-Since'),
+}
+
+# Zip archives and PDF files are read from the trailing index (the central
+# directory or xref table) on, so they are fetched by ranges
+_RANGE_MIME_TYPES = ['application/epub+zip', 'application/pdf']
+
 #------------------------------------------------------------------------------
 
 class Content:
     """ Representation of content retrieved from URL.
     """
 
-    def __init__(self, url, mime_type, istream):
+    def __init__(self, url, mime_type, istream, charset=None, lang=None,
+            validators=None):
         self._url = url
         self._type = _CONTENT_TYPE_MAP.get(mime_type)
         if not self._type:
@@ -254,6 +792,9 @@ class Content:
                     msg='Unsupported mime type: %s' % mime_type,
                     hdrs=None, fp=None)
         self._istream = istream
+        self._charset = charset
+        self._lang = lang
+        self._validators = validators or {}
         self._title = None
         self._author = None
 
@@ -269,23 +810,49 @@ class Content:
     def author(self):
         return self._author
 
+    @property
+    def lang(self):
+        """Language declared by the content or in http headers."""
+        return self._lang
+
+    @property
+    def validators(self):
+        """``ETag`` and ``Last-Modified`` values of the response, if any."""
+        return self._validators
+
     def to_json(self):
         assert self._type == CONTENT_JSON
         return json.load(self._istream)
 
+    @staticmethod
+    def _get_spine_documents(book):
+        """Return book documents in reading (spine) order.
+        """
+        items = [book.get_item_with_id(idref) for idref, _ in book.spine]
+        items = [item for item in items
+                if item is not None and item.get_type() == ITEM_DOCUMENT]
+
+        return items or list(book.get_items_of_type(ITEM_DOCUMENT))
+
     def generate_html_chunks(self):
-        assert self._type in [CONTENT_HTML, CONTENT_EPUB]
+        assert self._type in [CONTENT_HTML, CONTENT_EPUB, CONTENT_PDF]
 
         if self._type == CONTENT_HTML:
             log.debug('Reading raw HTML from %s', self._url)
 
-            yield self._istream.read()
+            with STAGE_SECONDS.time(stage='html_parse'):
+                rawhtml, lang = _parse_html_stream(self._istream,
+                        self._charset, settings.html['max_size'],
+                        settings.html['chunk_size'])
+
+            self._lang = lang or self._lang
+
+            yield rawhtml
 
         elif self._type == CONTENT_EPUB:
             log.debug('Reading ePub from %s', self._url)
 
-            ios = lazygen.BufferedRandomReader(self._istream)
-            book = epub.read_epub(ios)
+            book = epub.read_epub(self._get_seekable_stream())
 
             self._title, self._author = book.title, ''
 
@@ -293,14 +860,43 @@ class Content:
             if authors:
                 self._author = authors[0][0]
 
-            for doc_item in book.get_items_of_type(ITEM_DOCUMENT):
+            langs = book.get_metadata('DC', 'language')
+            if langs:
+                self._lang = langs[0][0]
+
+            for doc_item in Content._get_spine_documents(book):
                 yield doc_item.content
 
         elif self._type == CONTENT_PDF:
-            yield ''
+            if not pdftext.available:
+                yield ''
+                return
+
+            log.debug('Reading PDF from %s', self._url)
+
+            reader = pdftext.PdfReader(self._get_seekable_stream())
+
+            self._title, self._author = reader.title, reader.author
+            self._lang = reader.lang or self._lang
+
+            for page in reader.generate_html_pages(settings.pdf['max_pages']):
+                yield page
+
+    def _get_seekable_stream(self):
+        """Return input stream, buffering it for random access if needed.
+        """
+        if hasattr(self._istream, 'seek'):
+            return self._istream
+
+        return lazygen.BufferedRandomReader(self._istream,
+                spill_size=settings.epub_spill_size)
 
 #------------------------------------------------------------------------------
 
+# Paragraphs of streamed documents are cleaned in batches of about that many
+# seconds of CPU executor time
+_STREAM_BATCH_SECONDS = 0.01
+
 class Extractor:
 
     def __init__(self):
@@ -311,32 +907,376 @@ class Extractor:
         self._rdd_api_url = rdd_parser['uri']
         self._rdd_api_key = rdd_parser['token']
 
-    def extract(self, url):
+        self._cache = Extractor._create_cache(settings.doc_cache)
+
+        lock_dir = settings.single_flight['lock_dir']
+        if lock_dir:
+            lock_dir = path.join(path.dirname(__file__), lock_dir)
+
+        self._flight = SingleFlight(lock_dir,
+                settings.single_flight['lock_stripes'])
+
+        self._refresher = Extractor._create_refresher(settings.refresh)
+
+        self._fetcher = Extractor._create_fetcher(settings.fetch)
+
+        self._cpu_executor = None
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def fetcher(self):
+        return self._fetcher
+
+    @property
+    def flight(self):
+        return self._flight
+
+    @property
+    def refresher(self):
+        return self._refresher
+
+    def set_cpu_executor(self, executor):
+        """Offload CPU-bound parsing to ``executor(func, *args)``, which must
+        return ``func(*args)``. E.g., asynchronous servers pass a thread pool
+        here so that parsing doesn't stall their event loop.
+        """
+        self._cpu_executor = executor
+
+    def set_cache(self, cache):
+        """Use ``cache`` (a :class:`doccache.DocumentCache` or ``None``) for
+        extracted documents instead of the one configured in settings.
+        """
+        self._cache = cache
+
+    def extract(self, url, stale=True):
+        """Return readable document for ``url``. With ``stale``, document
+        that expired in cache less than ``refresh.max_stale`` seconds ago is
+        returned right away and extracted again in background.
+        """
+        doc, staleness = self._lookup(url)
+
+        if doc is not None and not staleness:
+            log.info('Returning cached content for %s', url)
+            return doc
+
+        stale_doc = self._serve_stale(url, doc, staleness) if stale else None
+
+        if stale_doc is not None:
+            log.info('Returning stale content for %s', url)
+            return stale_doc
+
+        return self._extract_once(url, expired=doc)
+
+    def extract_stream(self, url):
+        """Generate JSON records for the document at ``url`` while it's being
+        extracted: a ``header`` record with document metadata, one
+        ``paragraph`` record per cleaned paragraph and a final ``trailer``
+        record with ``lang``, ``word_count`` and ``direction``.
+        """
+        doc, staleness = self._lookup(url)
+
+        if doc is not None and not staleness:
+            log.info('Streaming cached content for %s', url)
+            return Extractor._replay_stream(doc)
+
+        stale_doc = self._serve_stale(url, doc, staleness)
+
+        if stale_doc is not None:
+            log.info('Streaming stale content for %s', url)
+            return Extractor._replay_stream(stale_doc)
+
+        return self._extract_stream(url, expired=doc)
+
+    @staticmethod
+    def _replay_stream(doc):
+
+        yield Extractor._stream_header(doc)
+
+        if doc.content:
+            for parag in doc.content.split('\n'):
+                yield dict(type='paragraph', text=parag)
+
+        yield Extractor._stream_trailer(doc)
+
+    @staticmethod
+    def _stream_header(doc):
+        header = doc.to_json()
+        for key in ['content', 'lang', 'word_count', 'direction']:
+            header.pop(key, None)
+        header['type'] = 'header'
+        return header
+
+    @staticmethod
+    def _stream_trailer(doc):
+        return dict(type='trailer', lang=doc.lang, direction=doc.direction,
+                word_count=getattr(doc, 'word_count', 0))
+
+    def _extract_stream(self, url, expired=None):
+        """Extract ``url`` in background thread as :meth:`extract` does,
+        generating records of paragraphs as soon as they're cleaned. If
+        there's nothing to stream that way (e.g., the document is extracted
+        by a concurrent request or by racing parsers), the document is
+        replayed once it's ready.
+        """
+        records = Queue.Queue()
+        streamed = []
+
+        def on_paragraph(doc, parag):
+            if not streamed:
+                streamed.append(True)
+                records.put((Extractor._stream_header(doc), None))
+            records.put((dict(type='paragraph', text=parag), None))
+
+        def run():
+            try:
+                records.put((self._extract_once(url, on_paragraph, expired),
+                        None))
+            except Exception:
+                records.put((None, sys.exc_info()))
+
+        thread = threading.Thread(target=run, name='stream')
+        thread.daemon = True
+        thread.start()
+
+        while True:
+            record, error = records.get()
+
+            if error is not None:
+                raise error[0], error[1], error[2]
+
+            if isinstance(record, CleanDocument):
+                break
+
+            yield record
+
+        if not streamed:
+            for record in Extractor._replay_stream(record):
+                yield record
+        else:
+            yield Extractor._stream_trailer(record)
+
+    def _get_shared(self, url):
+        return self._cache.get_shared(url) if self._cache else None
+
+    def _lookup(self, url):
+        """Return ``(doc, staleness)`` of cached document for ``url`` (see
+        :meth:`doccache.DocumentCache.lookup`).
+        """
+        return self._cache.lookup(url) if self._cache else (None, None)
+
+    def _serve_stale(self, url, doc, staleness):
+        """Return copy of ``doc`` of ``url`` that expired ``staleness``
+        seconds ago scheduling its refresh, or ``None`` if it isn't recent
+        enough.
+        """
+        if (self._refresher is None or not staleness or
+                staleness > settings.refresh['max_stale']):
+            return None
+
+        self._refresher.schedule(normalize_url(url),
+                lambda: self._extract_once(url, expired=doc))
+
+        return doc.stale_copy()
+
+    def _extract_once(self, url, on_paragraph=None, expired=None):
+        # Concurrent requests for the same url share a single extraction,
+        # paragraphs are passed to ``on_paragraph`` of the leading one only
+        return self._flight.do(normalize_url(url),
+                lambda: self._extract_and_cache(url, on_paragraph, expired),
+                recheck=lambda: self._get_shared(url))
+
+    def _revalidate(self, url, stale):
+        """Return ``(stale, content)`` for expired cached ``stale`` document
+        of ``url`` with validators of its source: ``stale`` document if the
+        source hasn't been modified since, or ``content`` of the modified
+        source to parse. Both are ``None`` if there's nothing to revalidate.
+        """
+        validators = stale.validators if stale else None
+
+        if not validators:
+            return None, None
+
+        try:
+            content = self._get_raw_content(stale.source_url,
+                    validators=validators)
+
+        except urllib2.HTTPError as err:
+            if err.code != 304:
+                raise
+
+            log.info('Not modified since cached: %s', url)
+            REVALIDATIONS.inc(result='not_modified')
+
+            return stale, None
+
+        log.info('Modified since cached: %s', url)
+        REVALIDATIONS.inc(result='modified')
+
+        return None, content
+
+    def _extract_and_cache(self, url, on_paragraph=None, expired=None):
+
+        doc = self._extract(url, on_paragraph, expired)
+
+        if self._cache and Extractor._is_cacheable(doc):
+            self._cache.put(url, doc)
+
+        return doc
+
+    def _extract(self, url, on_paragraph=None, expired=None):
+        """Return readable document for ``url``, passing its paragraphs to
+        ``on_paragraph(doc, paragraph)`` as soon as they're cleaned, unless
+        parsers are racing. ``expired`` cached document is revalidated first.
+        """
+        stale, content = self._revalidate(url, expired)
+
+        if stale is not None:
+            return stale
+
+        if content is not None:
+            # Modified since parsed locally, it's parsed locally again
+            return self._update_content(CleanDocument(url), content,
+                    on_paragraph)
+
+        if settings.extract_mode == 'race':
+            return self._extract_racing(url)
 
         # Try getting Readability content first
-        doc = self._get_from_rdd(url)
+        doc = self._get_from_rdd(url, on_paragraph)
 
         # Parse locally if Readability content is empty
         if doc.is_empty():
             log.warn('Readability content is empty, running local parser.')
-            self._update_content(doc)
+            LOCAL_FALLBACKS.inc()
+            self._update_content(doc, on_paragraph=on_paragraph)
         else:
             log.info('Returning Readability content.')
 
         return doc
 
-    def _get_from_rdd(self, url):
-        """Use Readability online API.
+    def _extract_racing(self, url):
+        """Run Readability API and local parser concurrently, return the
+        first non-empty document.
         """
-        # Save the round-trip if we're confident ``url`` cannot be parsed
+        url_type = Extractor._guess_url_type(url)
+
+        if url_type:
+            log.warn('ePub/pdf CANNOT be parsed with Readability: %s', url)
+            return self._update_content(CleanDocument(url, url_type))
+
+        results = Queue.Queue()
+
+        def run(name, func):
+            try:
+                results.put((name, func(url), None))
+            except Exception:
+                results.put((name, None, sys.exc_info()))
+
+        pool = Extractor._get_pool()
+        pool.apply_async(run, ('readability', self._get_from_rdd))
+        pool.apply_async(run, ('local', self._get_from_local))
+
+        outcomes = {}
+
+        for _ in range(2):
+            name, doc, error = results.get()
+
+            if doc is not None and not doc.is_empty():
+                # The other job carries on in background, its result is lost
+                log.info('Returning %s content.', name)
+                if name == 'local':
+                    LOCAL_FALLBACKS.inc()
+                return doc
+
+            log.warn('Racing %s parser came up empty.', name)
+            outcomes[name] = (doc, error)
+
+        doc, error = outcomes['local']
+
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+        return doc
+
+    def _get_from_local(self, url):
+        return self._update_content(CleanDocument(url))
+
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    @staticmethod
+    def _get_pool():
+        with Extractor._pool_lock:
+            if Extractor._pool is None:
+                Extractor._pool = ThreadPool(settings.extract_workers)
+        return Extractor._pool
+
+    def _run_cpu_bound(self, func, *args):
+        if self._cpu_executor is None:
+            return func(*args)
+        return self._cpu_executor(func, *args)
+
+    @staticmethod
+    def _guess_url_type(url):
         urll = url.lower()
 
         if urll.endswith('.epub'):
-            url_type = CONTENT_EPUB
+            return CONTENT_EPUB
         elif urll.endswith('.pdf'):
-            url_type = CONTENT_PDF
-        else:
-            url_type = None
+            return CONTENT_PDF
+
+        return None
+
+    @staticmethod
+    def _create_refresher(config):
+        if not config['enabled']:
+            return None
+
+        return Refresher(workers=config['workers'],
+                max_pending=config['max_pending'])
+
+    @staticmethod
+    def _create_fetcher(config):
+        if not config['pooled']:
+            return None
+
+        return Fetcher(connect_timeout=config['connect_timeout'],
+                read_timeout=config['read_timeout'],
+                max_size=config['max_size'],
+                max_idle=config['max_idle'],
+                max_redirects=config['max_redirects'],
+                dns_ttl=config['dns_ttl'],
+                debuglevel=settings.app_debug)
+
+    @staticmethod
+    def _create_cache(config):
+        if not config['enabled']:
+            return None
+
+        disk_path = config['disk_path']
+        if disk_path:
+            disk_path = path.join(path.dirname(__file__), disk_path)
+
+        return DocumentCache(CleanDocument.from_bytes,
+                memory_size=config['memory_size'],
+                ttl=config['ttl'],
+                disk_path=disk_path,
+                disk_items=config['disk_items'],
+                max_stale=config['max_stale'])
+
+    @staticmethod
+    def _is_cacheable(doc):
+        # Don't keep failures around, they may be transient
+        return not doc.is_empty() or hasattr(doc, 'preprocess')
+
+    def _get_from_rdd(self, url, on_paragraph=None):
+        """Use Readability online API.
+        """
+        # Save the round-trip if we're confident ``url`` cannot be parsed
+        url_type = Extractor._guess_url_type(url)
 
         if url_type:
             log.warn('ePub/pdf CANNOT be parsed with Readability: %s', url)
@@ -348,9 +1288,10 @@ class Extractor:
         log.info('Getting Readability content from %s', rdd_req)
 
         try:
-            content = Extractor._get_raw_content(rdd_req, 'application/json')
+            with STAGE_SECONDS.time(stage='readability_api'):
+                content = self._get_raw_content(rdd_req, 'application/json')
 
-            rdd_doc = CleanDocument.from_json(content.to_json())
+                rdd_doc = CleanDocument.from_json(content.to_json())
 
         except urllib2.HTTPError as err:
             log.error('Readability error for %s: %d', rdd_req, err.code)
@@ -358,65 +1299,223 @@ class Extractor:
             rdd_doc = CleanDocument(url) # empty document fallback
 
         # convert html to text
-        rdd_doc.textify()
+        self._textify(rdd_doc, on_paragraph)
 
         return rdd_doc
 
-    def _update_content(self, doc):
-        """Get readable content using local parser.
+    def _update_content(self, doc, content=None, on_paragraph=None):
+        """Get readable content using local parser, fetching it unless
+        ``content`` is given.
         """
-        if doc.url_type != CONTENT_PDF:
-            content = Extractor._get_raw_content(doc.source_url)
-            doc.url_type = content.type
-
-        if doc.url_type == CONTENT_PDF:
-            preproc_url = 'http://get-html.appspot.com/q?'
-            doc.preprocess = preproc_url + urllib.urlencode( {'u':doc.url} )
+        if doc.url_type == CONTENT_PDF and not pdftext.available:
+            Extractor._set_preprocess(doc)
             return doc
 
-        word_count, clean, title = 0, [], None
+        if content is None:
+            content = self._get_raw_content(doc.source_url)
+
+        doc.url_type = content.type
 
-        for rawhtml in content.generate_html_chunks():
-            if rawhtml:
+        if content.validators:
+            doc.validators = content.validators
 
-                rddoc = readability.Document(rawhtml)
+        if doc.url_type == CONTENT_PDF and not pdftext.available:
+            Extractor._set_preprocess(doc)
+            return doc
 
-                title = title or rddoc.short_title()
+        word_count, clean, title = 0, [], None
 
-                doc.content = rddoc.summary()
+        for chunk_title, text, chunk_words in self._parse_chunks(doc, content,
+                on_paragraph):
 
-                # convert html to text
-                doc.textify()
+            title = title or chunk_title
 
-                clean.append(doc.content)
+            clean.append(text)
 
-                word_count += doc.word_count
+            word_count += chunk_words
 
         doc.title   = content.title or title
         doc.author  = content.author
-        doc.content = ''.join(clean)
+        doc.content = '\n'.join(clean)
         doc.word_count = word_count
 
+        return doc
+
+    @staticmethod
+    def _set_preprocess(doc):
+        """Point the client to external service converting ``doc`` to HTML.
+        """
+        preproc_url = 'http://get-html.appspot.com/q?'
+        doc.preprocess = preproc_url + urllib.urlencode( {'u':doc.url} )
+
+    @staticmethod
+    def _summarize(rawhtml, with_title=True):
+        """Return ``(title, html)`` tuple of readable ``rawhtml`` summary, the
+        title is ``None`` unless it's asked for ``with_title`` (finding it is
+        another parse of ``rawhtml``).
+        """
+        with STAGE_SECONDS.time(stage='readability_parse'):
+            rddoc = readability.Document(rawhtml)
+
+            title = rddoc.short_title() if with_title else None
+
+            return title, rddoc.summary()
+
+    def _parse_chunks(self, doc, content, on_paragraph=None):
+        """Generate ``(title, text, word_count)`` for every readable chunk of
+        ``content`` in order. Once the language of ePub book is decided, the
+        rest of its chapters are parsed by a process pool, if there is one.
+        """
+        chunks = (rawhtml for rawhtml in content.generate_html_chunks()
+                if rawhtml)
+
+        # PDF pages are plain text already, there's nothing to summarize
+        summarize = content.type != CONTENT_PDF
+
+        title = None
+
+        for rawhtml in chunks:
+            doc.set_lang_hint(content.lang)
+
+            # Chunk titles are looked for until there's one, but never in
+            # ePub chapters: the book title is taken anyway
+            with_title = (content.type != CONTENT_EPUB and
+                    not (content.title or title))
+
+            if summarize:
+                chunk_title, doc.content = self._run_cpu_bound(
+                        Extractor._summarize, rawhtml, with_title)
+            else:
+                chunk_title, doc.content = None, rawhtml
+
+            # Metadata is set early for paragraphs passed on while parsing
+            title = title or chunk_title
+            doc.title, doc.author = content.title or title, content.author
+
+            doc.word_count = 0 # in case there's nothing to textify
+
+            self._textify(doc, on_paragraph, final=False)
+
+            yield chunk_title, doc.content, doc.word_count
+
+            if (content.type == CONTENT_EPUB and doc.is_lang_decided() and
+                    _get_process_pool()):
+                break
+        else:
+            # Decide on all the text sampled, unless nothing was textified
+            if doc.lang is not None:
+                doc.decide_lang()
+            return
+
+        log.info('Parsing ePub chapters in process pool, lang %s', doc.lang)
+
+        tasks = ((rawhtml, doc.lang) for rawhtml in chunks)
+
+        for data, stages in _get_process_pool().imap(_parse_chapter, tasks):
+            STAGE_SECONDS.merge(stages)
+
+            chapter = CleanDocument.from_bytes(data)
+
+            if on_paragraph is not None and chapter.content:
+                for parag in chapter.content.split('\n'):
+                    on_paragraph(doc, parag)
+
+            yield chapter.title, chapter.content, chapter.word_count
+
+    def _textify(self, doc, on_paragraph=None, final=True):
+        """Convert html content of ``doc`` to text, passing its paragraphs to
+        ``on_paragraph(doc, paragraph)``. Unless it's ``final``, more content
+        of ``doc`` follows.
+
+        Paragraphs are cleaned in the CPU executor either way. When they're
+        passed on, that's done a batch at a time and the callback is called
+        in this thread, as it may not be safe to call from the executor.
+        """
+        if on_paragraph is None:
+            self._run_cpu_bound(doc.textify, None, final)
+            return
+
+        if not doc.content:
+            return
+
+        paragraphs = doc.generate_paragraphs(final)
+        clean, seconds = [], 0
+
+        while True:
+            batch, elapsed = self._run_cpu_bound(Extractor._clean_batch,
+                    paragraphs)
+
+            seconds += elapsed
+
+            for parag in batch:
+                on_paragraph(doc, parag)
+
+            clean.extend(batch)
+
+            if not batch:
+                break
+
+        doc.content = '\n'.join(clean)
+
+        STAGE_SECONDS.observe(seconds, stage='textify')
+
     @staticmethod
-    def _get_raw_content(url, mime=None, allowgzip=True):
+    def _clean_batch(paragraphs):
+        """Return ``(batch, seconds)``: list of the next paragraphs cleaned by
+        ``paragraphs`` generator within :data:`_STREAM_BATCH_SECONDS` (empty
+        at its end) and the time it took.
+        """
+        start = time.time()
+        batch = []
+
+        for parag in paragraphs:
+            batch.append(parag)
+
+            if time.time() - start >= _STREAM_BATCH_SECONDS:
+                break
+
+        return batch, time.time() - start
+
+    def _open_url(self, url, headers):
+        if self._fetcher:
+            return self._fetcher.open(url, headers)
+
+        return urllib2.urlopen(urllib2.Request(url, headers=headers))
+
+    def _get_raw_content(self, url, mime=None, allowgzip=True,
+            validators=None):
         """ Get data from given url.
 
         Return file-like object so it can be fed to json.load()
+
+        The request is conditional with ``validators`` of an earlier response;
+        :exc:`urllib2.HTTPError` with code 304 is raised if not modified.
         """
 
-        req = urllib2.Request(url)
+        headers = {}
 
         if mime:
-            req.add_header('Accept', mime)
+            headers['Accept'] = mime
 
         if allowgzip:
-            req.add_header('Accept-Encoding', 'gzip,deflate')
+            headers['Accept-Encoding'] = 'gzip,deflate'
+
+        for key, (_, header) in _VALIDATOR_HEADERS.iteritems():
+            if validators and validators.get(key):
+                headers[header] = validators[key]
 
-        resp = urllib2.urlopen(req)
+        with STAGE_SECONDS.time(stage='fetch'):
+            resp = self._open_url(url, headers)
 
         meta = resp.info()
 
         mime_type = (meta.gettype() or '').lower()
+        charset = meta.getparam('charset')
+        lang = meta.getheader('content-language')
+
+        validators = dict((key, meta.getheader(header))
+                for key, (header, _) in _VALIDATOR_HEADERS.iteritems()
+                if meta.getheader(header))
 
         log.debug('Opening mime type "%s"', mime_type)
 
@@ -426,6 +1525,21 @@ class Extractor:
         log.debug('Content type: "%s"', content_type)
         log.debug('Content encoding: "%s"', content_encoding)
 
+        if mime_type in _RANGE_MIME_TYPES:
+            size = supports_ranges(resp)
+
+            if size is not None and size >= settings.fetch['range_min_size']:
+                log.debug('Reading %d bytes from %s by ranges', size, url)
+
+                resp.close()
+
+                istream = RangeReader(self._open_url, resp.geturl(), size,
+                        block_size=settings.fetch['range_block_size'],
+                        max_blocks=settings.fetch['range_max_blocks'])
+
+                return Content(url, mime_type, istream, lang=lang,
+                        validators=validators)
+
         # we'll gunzip even if not allowgzip :)
         if content_encoding.lower() in ['gzip', 'deflate']:
             log.debug('Decompressing gzip/deflate response.')
@@ -434,10 +1548,116 @@ class Extractor:
 
             istream = lazygen.StringGenStream(gunzip_gen)
 
-            return Content(url, mime_type, istream)
+            return Content(url, mime_type, istream, charset, lang,
+                    validators)
+
+        return Content(url, mime_type, resp, charset, lang, validators)
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def start_process_pool():
+    """Create process pool for parsing ePub chapters, unless it's disabled
+    in settings or by :func:`disable_process_pool`. Call it at startup, while
+    there are no other threads: children forked from a process with threads
+    running may deadlock on locks held by them.
+    """
+    global _process_pool
+
+    with _process_pool_lock:
+        if _process_pool is None and settings.epub_workers > 0:
+            try:
+                _process_pool = multiprocessing.Pool(settings.epub_workers,
+                        initializer=_init_chapter_worker)
+            except (ImportError, OSError) as err:
+                log.error('Cannot create process pool: %r', err)
+                _process_pool = False
+
+def disable_process_pool():
+    """Parse ePub chapters in the calling process from now on, e.g., where
+    child processes can't be forked safely.
+    """
+    global _process_pool
+
+    with _process_pool_lock:
+        _process_pool = False
 
-        return Content(url, mime_type, resp)
+def _get_process_pool():
+    """Return process pool for parsing ePub chapters or ``None`` if it isn't
+    started.
+    """
+    return _process_pool or None
+
+def _init_chapter_worker():
+    # Forget stage timings inherited from the parent, they're counted there
+    STAGE_SECONDS.drain()
+
+def _parse_chapter(task):
+    """Process pool job: return packed document of ePub chapter ``rawhtml``
+    in language ``lang``, along with stage timings of the job to merge into
+    the parent's metrics. Chapters aren't titled, the book title is used.
+    Other metrics of the workers (e.g., hyphenation cache stats) aren't
+    collected.
+    """
+    rawhtml, lang = task
+
+    doc = CleanDocument(None, CONTENT_EPUB, lang_hint=lang)
+
+    _, doc.content = Extractor._summarize(rawhtml, with_title=False)
+
+    doc.word_count = 0 # in case there's nothing to textify
+
+    doc.textify()
+
+    return doc.to_bytes(), STAGE_SECONDS.drain()
+
+def _register_metrics(extractor):
+
+    def samples(stats, **labels):
+        return [(labels.items() + [('event', event)], value)
+                for event, value in stats.iteritems()
+                if event not in ['max_size', 'size', 'items', 'in_flight',
+                    'idle', 'entries', 'pending']]
+
+    def cache_samples():
+        if not extractor.cache:
+            return []
+        return [sample for tier, stats in extractor.cache.stats().iteritems()
+                for sample in samples(stats, tier=tier)]
+
+    def fetch_samples():
+        if not extractor.fetcher:
+            return []
+        totals = {}
+        for stats in extractor.fetcher.stats()['pools'].itervalues():
+            for event, value in stats.iteritems():
+                totals[event] = totals.get(event, 0) + value
+        return samples(totals)
+
+    def dns_samples():
+        if not extractor.fetcher:
+            return []
+        return samples(extractor.fetcher.stats()['dns'])
+
+    registry.callback('spritsit_doc_cache_events_total',
+            'Document cache hits, misses and evictions.',
+            cache_samples, type='counter')
+    registry.callback('spritsit_single_flight_total',
+            'Extractions that led, joined or reused another one in flight.',
+            lambda: samples(extractor.flight.stats()), type='counter')
+    registry.callback('spritsit_refresh_total',
+            'Background refreshes of stale documents by outcome.',
+            lambda: samples(extractor.refresher.stats())
+                if extractor.refresher else [], type='counter')
+    registry.callback('spritsit_fetch_connections_total',
+            'Upstream connections created, reused and discarded.',
+            fetch_samples, type='counter')
+    registry.callback('spritsit_dns_cache_total',
+            'DNS cache hits and misses.',
+            dns_samples, type='counter')
 
 # Global extractor instance
 extractor = Extractor()
 
+_register_metrics(extractor)
+
@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+
+"""HTTP fetching over persistent per-host connection pools.
+
+A drop-in for the bits of ``urllib2.urlopen`` the extractor relies on: the
+returned response is a file-like object with ``info()`` and ``geturl()``,
+HTTP errors are raised as :exc:`urllib2.HTTPError` and network errors as
+:exc:`urllib2.URLError`. Unlike ``urllib2`` it keeps connections alive and
+returns them to the pool once a response has been fully read, caches DNS
+lookups, enforces separate connect/read timeouts and a response size limit.
+
+:class:`RangeReader` turns a URL served with ``Accept-Ranges: bytes`` into a
+seekable file, so that formats with trailing indexes (e.g., zip archives) can
+be read without downloading them whole.
+"""
+
+import sys
+import ssl
+import time
+import socket
+import urllib2
+import httplib
+import logging
+import threading
+import urlparse
+
+from os import SEEK_SET, SEEK_CUR, SEEK_END
+
+from lrucache import LRUCache
+
+#------------------------------------------------------------------------------
+
+# App logger
+log = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+
+USER_AGENT = 'Python-urllib/%s' % sys.version[:3]
+
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+class ResponseTooLarge(urllib2.URLError):
+    """Raised when response body exceeds the configured maximal size."""
+
+class RangeNotSatisfied(urllib2.URLError):
+    """Raised when server doesn't honour a ``Range`` request."""
+
+#------------------------------------------------------------------------------
+
+class DnsCache(object):
+    """Cache of ``getaddrinfo()`` results with time-to-live of ``ttl`` seconds.
+    """
+
+    def __init__(self, ttl=300):
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._hits = self._misses = 0
+
+    def resolve(self, host, port):
+        key = (host, port)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._hits += 1
+                return entry[1]
+            self._misses += 1
+
+        addrs = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+        with self._lock:
+            self._entries[key] = (now + self._ttl, addrs)
+
+        return addrs
+
+    def invalidate(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self._hits, misses=self._misses,
+                    entries=len(self._entries))
+
+def _create_connection(dns, host, port, connect_timeout, read_timeout):
+    """Like ``socket.create_connection()`` but resolves through ``dns``."""
+    error = None
+
+    for family, socktype, proto, _, sockaddr in dns.resolve(host, port):
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(connect_timeout)
+            sock.connect(sockaddr)
+            sock.settimeout(read_timeout)
+            return sock
+        except socket.error as err:
+            error = err
+            if sock is not None:
+                sock.close()
+
+    dns.invalidate(host, port) # maybe the host has moved
+
+    raise error or socket.error('getaddrinfo returns an empty list')
+
+class _HTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, host, port, dns, connect_timeout, read_timeout):
+        httplib.HTTPConnection.__init__(self, host, port)
+        self._dns = dns
+        self._timeouts = (connect_timeout, read_timeout)
+
+    def connect(self):
+        self.sock = _create_connection(self._dns, self.host, self.port,
+                *self._timeouts)
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+
+    def __init__(self, host, port, dns, connect_timeout, read_timeout):
+        httplib.HTTPSConnection.__init__(self, host, port)
+        self._dns = dns
+        self._timeouts = (connect_timeout, read_timeout)
+
+    def connect(self):
+        sock = _create_connection(self._dns, self.host, self.port,
+                *self._timeouts)
+
+        context = getattr(self, '_context', None) # python 2.7.9+
+
+        if context is not None:
+            self.sock = context.wrap_socket(sock, server_hostname=self.host)
+        else:
+            self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+
+_CONNECTION_CLASSES = {
+    'http'  : _HTTPConnection,
+    'https' : _HTTPSConnection,
+}
+
+#------------------------------------------------------------------------------
+
+class ConnectionPool(object):
+    """Idle keep-alive connections to a single ``(scheme, host, port)``.
+    """
+
+    def __init__(self, scheme, host, port, dns, max_idle, connect_timeout,
+            read_timeout, debuglevel=0):
+        self._args = (host, port, dns, connect_timeout, read_timeout)
+        self._conn_class = _CONNECTION_CLASSES[scheme]
+        self._debuglevel = debuglevel
+        self._max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._created = self._reused = self._discarded = 0
+
+    def acquire(self):
+        """Return ``(connection, reused)`` tuple."""
+        with self._lock:
+            if self._idle:
+                self._reused += 1
+                return self._idle.pop(), True
+            self._created += 1
+
+        conn = self._conn_class(*self._args)
+        conn.set_debuglevel(self._debuglevel)
+
+        return conn, False
+
+    def release(self, conn):
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(conn)
+                return
+            self._discarded += 1
+
+        conn.close()
+
+    def discard(self, conn):
+        with self._lock:
+            self._discarded += 1
+
+        conn.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(created=self._created, reused=self._reused,
+                    discarded=self._discarded, idle=len(self._idle))
+
+#------------------------------------------------------------------------------
+
+class PooledResponse(object):
+    """File-like HTTP response that gives its connection back to the pool as
+    soon as the body has been read completely.
+    """
+
+    def __init__(self, url, response, conn, pool, max_size):
+        self._url = url
+        self._response = response
+        self._conn = conn
+        self._pool = pool
+        self._max_size = max_size
+        self._bytes_read = 0
+
+    @property
+    def code(self):
+        return self._response.status
+
+    @property
+    def reason(self):
+        return self._response.reason
+
+    def info(self):
+        return self._response.msg
+
+    def geturl(self):
+        return self._url
+
+    def read(self, n=-1):
+        if self._conn is None:
+            return ''
+
+        if (n is None or n < 0) and self._max_size:
+            # Don't swallow more than the limit allows
+            n = self._max_size - self._bytes_read + 1
+
+        if n is None or n < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(n)
+
+        self._bytes_read += len(data)
+
+        if self._max_size and self._bytes_read > self._max_size:
+            self.close()
+            raise ResponseTooLarge('Response from %s exceeds %d bytes' % (
+                self._url, self._max_size))
+
+        if not data or self._response.isclosed():
+            self._release()
+
+        return data
+
+    def close(self):
+        """Close the response; unread body makes the connection unusable."""
+        if self._conn is not None:
+            self._response.close()
+            self._pool.discard(self._conn)
+            self._conn = None
+
+    def _release(self):
+        if self._response.will_close:
+            self._pool.discard(self._conn)
+        else:
+            self._pool.release(self._conn)
+        self._conn = None
+
+#------------------------------------------------------------------------------
+
+class Fetcher(object):
+    """Open URLs over pooled keep-alive connections.
+    """
+
+    def __init__(self, connect_timeout=10, read_timeout=30, max_size=None,
+            max_idle=4, max_redirects=5, dns_ttl=300, debuglevel=0):
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._max_size = max_size
+        self._max_idle = max_idle
+        self._max_redirects = max_redirects
+        self._debuglevel = debuglevel
+        self._dns = DnsCache(dns_ttl)
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def open(self, url, headers=None):
+        """GET ``url`` following redirects; return :class:`PooledResponse`.
+        """
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+
+        for _ in range(self._max_redirects + 1):
+            resp = self._request(url, headers or {})
+
+            if resp.code not in _REDIRECT_CODES:
+                break
+
+            location = resp.info().getheader('location')
+            resp.close()
+
+            if not location:
+                raise urllib2.HTTPError(url, resp.code,
+                        'Redirect without location', resp.info(), None)
+
+            url = urlparse.urljoin(url, location)
+
+            log.debug('Redirected to %s', url)
+        else:
+            raise urllib2.HTTPError(url, resp.code,
+                    'Too many redirects', resp.info(), None)
+
+        if resp.code == 304: # Not Modified, as urllib2 would raise it
+            resp.read() # there's no body, the connection is reusable
+
+        if resp.code >= 400 or resp.code == 304:
+            resp.close()
+            raise urllib2.HTTPError(url, resp.code, resp.reason,
+                    resp.info(), None)
+
+        return resp
+
+    def stats(self):
+        """Return DNS cache and per-host connection pool counters."""
+        with self._lock:
+            pools = self._pools.items()
+
+        return dict(dns=self._dns.stats(),
+                pools=dict(('%s://%s:%d' % key, pool.stats())
+                    for key, pool in pools))
+
+    def _get_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+
+        with self._lock:
+            pool = self._pools.get(key)
+
+            if pool is None:
+                pool = self._pools[key] = ConnectionPool(scheme, host, port,
+                        self._dns, self._max_idle, self._connect_timeout,
+                        self._read_timeout, self._debuglevel)
+
+        return pool
+
+    def _request(self, url, headers):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+
+        if scheme not in _CONNECTION_CLASSES:
+            raise urllib2.URLError('Unsupported URL scheme: %s' % scheme)
+
+        port = parts.port or (443 if scheme == 'https' else 80)
+        pool = self._get_pool(scheme, parts.hostname, port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        allheaders = {'User-Agent': USER_AGENT}
+        allheaders.update(headers)
+
+        while True:
+            conn, reused = pool.acquire()
+            try:
+                conn.request('GET', path, headers=allheaders)
+                response = conn.getresponse()
+                break
+            except (socket.error, httplib.HTTPException) as err:
+                pool.discard(conn)
+
+                # Idle connection might have been dropped by the server
+                if reused:
+                    log.debug('Stale connection to %s: %r', url, err)
+                    continue
+
+                raise urllib2.URLError(err)
+
+        return PooledResponse(url, response, conn, pool, self._max_size)
+
+#------------------------------------------------------------------------------
+
+def supports_ranges(resp):
+    """Return size of response body if its server accepts byte ranges for the
+    resource and the body is sent as is, ``None`` otherwise.
+    """
+    meta = resp.info()
+
+    if (meta.getheader('accept-ranges', '').lower() != 'bytes' or
+            meta.getheader('content-encoding', 'identity') != 'identity'):
+        return None
+
+    try:
+        return int(meta.getheader('content-length'))
+    except (TypeError, ValueError):
+        return None
+
+class RangeReader(object):
+    """Seekable read-only file over ``size`` bytes of ``url``.
+
+    Data is fetched with ``Range`` requests issued through ``open_url(url,
+    headers)`` in blocks of ``block_size`` bytes; adjacent missing blocks are
+    requested at once. At most ``max_blocks`` most recently used blocks are
+    kept in memory.
+    """
+
+    def __init__(self, open_url, url, size, block_size=262144, max_blocks=64):
+        self._open_url = open_url
+        self._url = url
+        self._size = size
+        self._block_size = block_size
+        self._blocks = LRUCache(max_blocks)
+        self._pos = 0
+        self._requests = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def requests(self):
+        return self._requests
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self._pos
+        elif whence == SEEK_END:
+            offset += self._size
+
+        if offset < 0:
+            raise IOError('Invalid seek position: %d' % offset)
+
+        self._pos = offset
+
+    def read(self, n=-1):
+        end = self._size if n is None or n < 0 else min(self._pos + n,
+                self._size)
+
+        if end <= self._pos:
+            return ''
+
+        first = self._pos // self._block_size
+        last = (end - 1) // self._block_size
+
+        blocks = self._get_blocks(first, last)
+
+        offset = self._pos - first * self._block_size
+        data = ''.join(blocks)[offset:offset + end - self._pos]
+
+        self._pos = end
+
+        return data
+
+    def close(self):
+        self._blocks.clear()
+
+    def _get_blocks(self, first, last):
+        blocks = [self._blocks.get(index) for index in range(first, last + 1)]
+
+        missing = [i for i, block in enumerate(blocks) if block is None]
+
+        if missing:
+            start, stop = first + missing[0], first + missing[-1]
+            fetched = self._fetch(start, stop)
+
+            for index in range(start, stop + 1):
+                block = fetched[(index - start) * self._block_size:
+                        (index - start + 1) * self._block_size]
+                self._blocks.put(index, block)
+                blocks[index - first] = block
+
+        return blocks
+
+    def _fetch(self, first, last):
+        start = first * self._block_size
+        end = min((last + 1) * self._block_size, self._size) - 1
+
+        log.debug('Fetching bytes %d-%d of %s', start, end, self._url)
+
+        self._requests += 1
+
+        resp = self._open_url(self._url, {'Range': 'bytes=%d-%d' % (start, end)})
+
+        try:
+            if resp.code != 206:
+                raise RangeNotSatisfied('Range request to %s returned %d' % (
+                    self._url, resp.code))
+
+            chunks = []
+            remaining = end + 1 - start
+
+            while remaining > 0:
+                chunk = resp.read(remaining)
+                if not chunk:
+                    raise RangeNotSatisfied('Short range response from %s' % (
+                        self._url))
+                chunks.append(chunk)
+                remaining -= len(chunk)
+
+            resp.read() # reach EOF, so that the connection can be reused
+        finally:
+            resp.close()
+
+        return ''.join(chunks)
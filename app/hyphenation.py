@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""Process-wide hyphenation dictionaries and memoized word wrapping.
+
+Loading a ``pyphen`` dictionary means reading and parsing a file, so every
+language is loaded once per process and shared by all requests. Results of
+``multiwrap()`` are kept in a bounded LRU cache, since long words (think of
+German or Finnish compounds) tend to repeat a lot.
+"""
+
+import pyphen
+
+from locks import native_lock
+from lrucache import LRUCache
+from settings import settings
+from metrics import registry, STAGE_SECONDS
+
+#------------------------------------------------------------------------------
+
+_dictionaries = {}
+_dictionaries_lock = native_lock()
+
+_wraps = LRUCache(settings.hyphen_cache_size)
+
+class Hyphenator(object):
+    """Shared ``pyphen.Pyphen`` instance for ``lang`` with cached wrapping.
+    """
+
+    def __init__(self, lang, pyphen_obj):
+        self._lang = lang
+        self._pyphen = pyphen_obj
+
+    @property
+    def lang(self):
+        return self._lang
+
+    def multiwrap(self, word, width):
+        key = (self._lang, word, width)
+
+        wrapped = _wraps.get(key)
+
+        if wrapped is None:
+            with STAGE_SECONDS.time(stage='hyphenation'):
+                wrapped = self._pyphen.multiwrap(word, width)
+            _wraps.put(key, wrapped)
+
+        return wrapped
+
+def get_hyphenator(lang):
+    """Return :class:`Hyphenator` for ``lang``, loading its dictionary on the
+    first call. Raises the ``pyphen`` error if there is no such dictionary.
+    """
+    with _dictionaries_lock:
+        hyphenator = _dictionaries.get(lang)
+
+        if hyphenator is None:
+            hyphenator = Hyphenator(lang, pyphen.Pyphen(lang=lang))
+            _dictionaries[lang] = hyphenator
+
+    return hyphenator
+
+def stats():
+    """Return loaded languages and word wrapping cache counters."""
+    with _dictionaries_lock:
+        langs = sorted(_dictionaries)
+
+    return dict(languages=langs, wraps=_wraps.stats())
+
+registry.callback('spritsit_hyphenation_cache_total',
+        'Hyphenation cache hits, misses and evictions.',
+        lambda: [([('event', event)], _wraps.stats()[event])
+            for event in ['hits', 'misses', 'evictions']],
+        type='counter')
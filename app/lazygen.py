@@ -7,11 +7,18 @@ that yields string objects when calling ``next()``.
 """
 
 from sys import maxsize
+from time import time
 from json import JSONEncoder
-from zlib import compressobj, decompressobj, MAX_WBITS
+from struct import pack
+from zlib import compressobj, decompressobj, crc32, MAX_WBITS, DEFLATED, \
+        Z_SYNC_FLUSH
 from io import BytesIO, SEEK_SET, SEEK_END
-from gzip import GzipFile
-from StringIO import StringIO
+from tempfile import TemporaryFile
+
+try:
+    from mmap import mmap, ACCESS_READ
+except ImportError: # e.g., Google App Engine
+    mmap = None
 
 def json_generator(obj, skipkeys=False):
     """Return generator that produces JSON strings for given obj.
@@ -34,6 +41,7 @@ def json_generator(obj, skipkeys=False):
 def gunzip_generator(fileobj, chunksize=1024):
     """Return generator for decompressing given file-like bytestream fileobj
     on the fly while using at most chunksize bytes in memory at a time.
+    Closing the generator before the end of input closes fileobj too.
 
     Example:
 
@@ -51,16 +59,71 @@ def gunzip_generator(fileobj, chunksize=1024):
         if not buffer:
             break
 
-        yield decoder.decompress(buffer)
+        try:
+            yield decoder.decompress(buffer)
+        except GeneratorExit: # the rest of input isn't wanted
+            fileobj.close()
+            raise
 
     lastchunk = decoder.flush()
 
     if lastchunk:
         yield lastchunk
 
-def deflate_generator(string_generator):
+def _coalesce(string_generator, chunk_size, max_delay, delimiter=None):
+    """Join generated strings into chunks of at least ``chunk_size`` bytes,
+    but yield a shorter chunk once ``max_delay`` seconds have passed since its
+    first string was generated (unless ``max_delay`` is ``None``), or when a
+    string ends with ``delimiter`` (unless it's ``None``). The delay is only
+    checked as strings come, so streams of records that may stall between
+    them (e.g., newline delimited JSON) should be delimited.
+
+    Example::
+
+        >>> list(_coalesce(iter(['a', 'bc', 'd', 'efg', 'h']), 3, None))
+        ['abc', 'defg', 'h']
+        >>> list(_coalesce(iter(['a', '\\n', 'b', 'c']), 3, None, '\\n'))
+        ['a\\n', 'bc']
+
+    """
+    buffer = []
+    size = 0
+    started = None
+
+    for string in string_generator:
+        if not string:
+            continue
+
+        if not buffer:
+            started = time()
+
+        buffer.append(string)
+        size += len(string)
+
+        if size >= chunk_size or (max_delay is not None and
+                time() - started >= max_delay) or (delimiter is not None and
+                string.endswith(delimiter)):
+            yield ''.join(buffer)
+            buffer, size = [], 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+def _compress_chunks(encoder, chunks):
+    for chunk in chunks:
+        data = encoder.compress(chunk) + encoder.flush(Z_SYNC_FLUSH)
+        if data:
+            yield data
+
+def deflate_generator(string_generator, level=6, chunk_size=16384,
+        max_delay=None, delimiter=None):
     """Return generator for compressing given string generator with zlib.
 
+    Input strings are coalesced into chunks of ``chunk_size`` bytes (or less,
+    once ``max_delay`` seconds have passed since the chunk was started or at
+    the end of a string ending with ``delimiter``), and compressed output is
+    flushed after each chunk.
+
     Example:
 
         >>> import zlib
@@ -69,15 +132,18 @@ def deflate_generator(string_generator):
         'hello, world!'
 
     """
-    encoder = compressobj()
+    encoder = compressobj(level)
 
-    for string in string_generator:
-        yield encoder.compress(string)
+    for data in _compress_chunks(encoder,
+            _coalesce(string_generator, chunk_size, max_delay, delimiter)):
+        yield data
 
     yield encoder.flush()
 
-def gzip_generator(string_generator):
-    """Return generator for gzipping given string generator.
+def gzip_generator(string_generator, level=6, chunk_size=16384,
+        max_delay=None, delimiter=None):
+    """Return generator for gzipping given string generator. Arguments are
+    the same as for :func:`deflate_generator`.
 
     Example:
 
@@ -87,35 +153,35 @@ def gzip_generator(string_generator):
         'hello, world!'
 
     """
-    # Use gzip and not zlib to make proper gzip header.
-    buffer = StringIO()
-    gzip = GzipFile(fileobj=buffer, mode='w')
+    # Raw deflate stream wrapped in gzip header and trailer (RFC 1952). The
+    # header has no timestamp, so the same input always gives the same bytes.
+    encoder = compressobj(level, DEFLATED, -MAX_WBITS)
 
-    # Yield header
-    yield buffer.getvalue()
-    buffer.truncate(0)
+    xfl = '\002' if level == 9 else '\004' if level == 1 else '\000'
 
-    for string in string_generator:
+    yield '\037\213\010\000' + pack('<L', 0) + xfl + '\377'
 
-        gzip.write(string)
-        gzip.flush()
+    crc, size = crc32(''), 0
 
-        yield buffer.getvalue()
-        buffer.truncate(0)
+    for chunk in _coalesce(string_generator, chunk_size, max_delay,
+            delimiter):
+        crc = crc32(chunk, crc)
+        size += len(chunk)
 
-    # Flush
-    gzip.close()
+        for data in _compress_chunks(encoder, [chunk]):
+            yield data
 
-    yield buffer.getvalue()
+    yield encoder.flush() + pack('<LL', crc & 0xffffffffL, size & 0xffffffffL)
 
-def compression_generator(string_generator, method):
+def compression_generator(string_generator, method, **kwargs):
     """Return generator for deflating/gzipping given string generator.
-    ``method`` can be either ``'deflate'`` or ``'gzip'``.
+    ``method`` can be either ``'deflate'`` or ``'gzip'``; keyword arguments
+    are passed to :func:`deflate_generator` or :func:`gzip_generator`.
     """
     if method == 'deflate':
-        return deflate_generator(string_generator)
+        return deflate_generator(string_generator, **kwargs)
     elif method == 'gzip':
-        return gzip_generator(string_generator)
+        return gzip_generator(string_generator, **kwargs)
     else:
         raise ValueError('Invalid compression method "%s"' % method)
 
@@ -141,19 +207,30 @@ def flat_string_generator(iterables, encoding='utf-8'):
 class StringGenStream:
     """Create a file-like stream created from string generator.
 
+    Generated strings are handed out by slicing, without intermediate copies;
+    reads that span several strings are assembled in a single preallocated
+    ``bytearray``.
+
     Example::
 
         >>> stream = StringGenStream(iter(['hello', ',', ' ', 'world']))
         >>> print stream.read(3)
         hel
+        >>> buf = bytearray(4)
+        >>> stream.readinto(buf), str(buf)
+        (4, 'lo, ')
         >>> print stream.read()
-        lo, world
+        world
+        >>> stream = StringGenStream(iter(['a\\nb', 'c\\n', 'd']))
+        >>> stream.readline(), stream.readline(), stream.readline()
+        ('a\\n', 'bc\\n', 'd')
 
     """
 
     def __init__(self, string_generator):
         self._string_generator = string_generator
-        self._accumulator = None
+        self._chunk = '' # current string
+        self._offset = 0 # read position in the current string
 
     def read(self, n=-1):
         """Read at most ``n`` bytes from the file (less if the ```read``` hits
@@ -163,29 +240,124 @@ class StringGenStream:
         file is reached. The bytes are returned as a string object. An empty
         string is returned when end of file is encountered immediately.
         """
-        if self._accumulator is None:
-            self._accumulator = StringIO()
-
         if n is None or n < 0: # exhaustive read
-            n = maxsize
+            head = self._take(len(self._chunk) - self._offset)
+            return head + ''.join(self._string_generator)
+
+        if not self._ensure_chunk():
+            return ''
+
+        if len(self._chunk) - self._offset >= n:
+            return self._take(n)
+
+        buffer = bytearray(n)
+        count = self.readinto(buffer)
+
+        if count < n:
+            del buffer[count:]
 
-        buffer = []
+        return str(buffer)
 
-        while n > 0:
-            nextstr = self._accumulator.read(n)
+    def readinto(self, b):
+        """Read up to ``len(b)`` bytes into writable buffer ``b`` and return
+        the number of bytes read (``0`` at end-of-file).
+        """
+        view = memoryview(b)
+        size = len(view)
+        count = 0
+
+        while count < size and self._ensure_chunk():
+            n = min(size - count, len(self._chunk) - self._offset)
+            view[count:count + n] = memoryview(self._chunk)[
+                    self._offset:self._offset + n]
+            self._offset += n
+            count += n
+
+        return count
+
+    def readline(self, limit=-1):
+        """Read until newline or end-of-file, but at most ``limit`` bytes if
+        it's not negative; the newline is kept in the returned string.
+        """
+        if limit is None or limit < 0:
+            limit = maxsize
+
+        buffer = None
+
+        while limit > 0 and self._ensure_chunk():
+            end = self._chunk.find('\n', self._offset,
+                    self._offset + limit) + 1
 
-            if nextstr:
-                buffer.append(nextstr)
-                n = n - len(nextstr)
+            if end:
+                line = self._take(end - self._offset)
             else:
-                # accumulator exhausted, generate next string
-                try:
-                    nextstr = next(self._string_generator)
-                    self._accumulator = StringIO(nextstr)
-                except StopIteration:
-                    n = 0 # stop
+                line = self._take(min(limit, len(self._chunk) - self._offset))
+
+            if buffer is None and (end or limit == len(line)):
+                return line # fast path: line within a single string
+
+            if buffer is None:
+                buffer = bytearray()
+
+            buffer += line
+            limit -= len(line)
+
+            if end:
+                break
 
-        return ''.join(buffer)
+        return str(buffer) if buffer is not None else ''
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        """Stop reading, closing the string generator if it can be closed
+        (e.g., to release its input).
+
+        Example::
+
+            >>> gen = (x for x in ['a', 'b'])
+            >>> stream = StringGenStream(gen)
+            >>> stream.read(1), stream.close(), stream.read()
+            ('a', None, '')
+            >>> list(gen)
+            []
+
+        """
+        string_generator = self._string_generator
+
+        self._string_generator = iter(())
+        self._chunk, self._offset = '', 0
+
+        if hasattr(string_generator, 'close'):
+            string_generator.close()
+
+    def _ensure_chunk(self):
+        """Make sure the current string has unread data, generating more as
+        needed. Return ``False`` at end-of-file.
+        """
+        while self._offset >= len(self._chunk):
+            try:
+                self._chunk = next(self._string_generator)
+            except StopIteration:
+                self._chunk, self._offset = '', 0
+                return False
+
+            self._offset = 0
+
+        return True
+
+    def _take(self, n):
+        if self._offset == 0 and n == len(self._chunk):
+            string = self._chunk # no need to copy
+        else:
+            string = self._chunk[self._offset:self._offset + n]
+
+        self._offset += n
+
+        return string
+
+_SPILL_COPY_SIZE = 64 * 1024
 
 def _ceil_div(a, b):
     return (a + b - 1) / b
@@ -197,6 +369,11 @@ class BufferedRandomReader:
     """Create random-access, read-only buffered stream adapter from a sequential
     input stream which does not support random access (i.e., ```seek()```)
 
+    Data read so far is kept in memory until it grows beyond ``spill_size``
+    bytes; then it's moved to a temporary file. Once the input is exhausted,
+    the file is memory-mapped, so random reads don't need extra copies (or
+    read as is, where ``mmap`` is unavailable).
+
     Example::
 
         >>> stream = BufferedRandomReader(BytesIO('abc'))
@@ -209,11 +386,13 @@ class BufferedRandomReader:
 
     """
 
-    def __init__(self, fin, chunk_size=512):
+    def __init__(self, fin, chunk_size=512, spill_size=None):
         self._fin = fin
         self._buf = BytesIO()
         self._eof = False
         self._chunk_size = chunk_size
+        self._spill_size = spill_size
+        self._file = None
 
     def tell(self):
         return self._buf.tell()
@@ -227,21 +406,21 @@ class BufferedRandomReader:
         string is returned when end of file is encountered immediately.
         """
         pos = self._buf.tell()
-        end = self._buf.seek(0, SEEK_END)
 
         if n < 0:
-            if not self._eof:
-                self._buf.write(self._fin.read())
-                self._eof = True
+            self._read_all()
         else:
-            req = pos + n - end
+            self._buf.seek(0, SEEK_END)
+            req = pos + n - self._buf.tell()
 
             if req > 0 and not self._eof: # need to grow
                 bcount = _align_up(req, self._chunk_size)
                 bytes  = self._fin.read(bcount)
 
-                self._buf.write(bytes)
-                self._eof = len(bytes) < bcount
+                self._append(bytes)
+
+                if len(bytes) < bcount:
+                    self._set_eof()
 
         self._buf.seek(pos)
 
@@ -250,17 +429,54 @@ class BufferedRandomReader:
     def seek(self, offset, whence=SEEK_SET):
 
         if whence == SEEK_END:
-            if not self._eof:
-                self._buf.seek(0, SEEK_END)
-                self._buf.write(self._fin.read())
-                self._eof = True
-            return self._buf.seek(offset, SEEK_END)
+            self._read_all()
 
-        return self._buf.seek(offset, whence)
+        self._buf.seek(offset, whence)
+
+        return long(self._buf.tell())
 
     def close(self):
         self._fin.close()
         self._buf.close()
+        if self._file is not None:
+            self._file.close()
+
+    def _read_all(self):
+        if self._eof:
+            return
+
+        self._buf.seek(0, SEEK_END)
+
+        while True:
+            bytes = self._fin.read(max(self._chunk_size, _SPILL_COPY_SIZE))
+            if not bytes:
+                break
+            self._append(bytes)
+
+        self._set_eof()
+
+    def _append(self, bytes):
+        """Write ``bytes`` at the end of buffer, spilling it to disk if it's
+        getting too large.
+        """
+        self._buf.write(bytes)
+
+        if (self._file is None and self._spill_size is not None and
+                self._buf.tell() > self._spill_size):
+
+            self._file = TemporaryFile()
+            self._file.write(self._buf.getvalue())
+            self._buf.close()
+            self._buf = self._file
+
+    def _set_eof(self):
+        self._eof = True
+
+        if self._file is not None and mmap is not None:
+            pos = self._buf.tell()
+            self._file.flush()
+            self._buf = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+            self._buf.seek(pos)
 
 if __name__ == "__main__":
     import doctest; doctest.testmod()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+"""Locks that stay native when threads are made green by gevent.
+
+Once ``gevent.monkey.patch_all()`` is done, ``threading.Lock`` is a gevent
+lock, which only works between greenlets of the same thread. CPU-bound work
+offloaded to gevent's thread pool runs in native threads though, so state it
+shares with greenlets (e.g., metrics and caches) is guarded by native locks.
+They are held for a few statements only, so greenlets blocking on them don't
+stall the event loop.
+"""
+
+import threading
+
+try:
+    from gevent import monkey
+except ImportError: # e.g., Google App Engine
+    monkey = None
+
+#------------------------------------------------------------------------------
+
+def native_lock():
+    """Return new native lock, even if ``threading`` is monkey-patched.
+
+    Example::
+
+        >>> lock = native_lock()
+        >>> lock.acquire(), lock.locked()
+        (True, True)
+
+    """
+    if monkey is None:
+        return threading.Lock()
+
+    return monkey.get_original('thread', 'allocate_lock')()
+
+if __name__ == "__main__":
+    import doctest; doctest.testmod()
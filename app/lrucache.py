@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""Thread-safe in-process LRU cache with optional time-to-live.
+"""
+
+import time
+
+from collections import OrderedDict
+
+from locks import native_lock
+
+#------------------------------------------------------------------------------
+
+def _unit_size(value):
+    return 1
+
+class LRUCache(object):
+    """Least-recently-used mapping bounded by the total *size* of its values.
+
+    ``sizeof`` is a callable returning the size of a value (every value counts
+    as ``1`` by default, so ``max_size`` is the item count). Entries older than
+    ``ttl`` seconds are treated as missing; ``ttl=None`` disables expiration.
+    Expired entries are kept for another ``max_stale`` seconds, during which
+    :meth:`lookup` returns them along with how long ago they expired.
+
+    Example::
+
+        >>> cache = LRUCache(2)
+        >>> cache.put('a', 1); cache.put('b', 2); cache.put('c', 3)
+        >>> cache.get('a') is None, cache.get('c')
+        (True, 3)
+        >>> cache.stats()['evictions']
+        1
+
+    """
+
+    def __init__(self, max_size, ttl=None, sizeof=None, max_stale=0):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._max_stale = max_stale
+        self._sizeof = sizeof or _unit_size
+        self._items = OrderedDict() # key -> (value, size, timestamp)
+        self._size = 0
+        self._lock = native_lock()
+        self._hits = self._misses = self._evictions = 0
+
+    def get(self, key, default=None):
+        value, staleness = self.lookup(key)
+
+        return default if staleness is None or staleness else value
+
+    def lookup(self, key, default=None):
+        """Return ``(value, staleness)`` for ``key``, where ``staleness`` is
+        ``0`` if the entry is fresh or else the seconds since it expired, or
+        ``(default, None)`` if there's no such entry. Only fresh entries count
+        as hits.
+
+        Example::
+
+            >>> cache = LRUCache(2, ttl=0, max_stale=60)
+            >>> cache.put('a', 1); time.sleep(0.01)
+            >>> value, staleness = cache.lookup('a')
+            >>> value, 0 < staleness < 60, cache.get('a')
+            (1, True, None)
+            >>> cache.lookup('b')
+            (None, None)
+
+        """
+        with self._lock:
+            item = self._items.get(key)
+
+            staleness = None if item is None else self._staleness(item)
+
+            if staleness is not None and staleness > self._max_stale:
+                del self._items[key]
+                self._size -= item[1]
+                staleness = None
+
+            if staleness is None:
+                self._misses += 1
+                return default, None
+
+            # Move to the most recent position
+            self._items[key] = self._items.pop(key)
+
+            if staleness:
+                self._misses += 1
+            else:
+                self._hits += 1
+
+            return item[0], staleness
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+
+            if size > self._max_size:
+                return # would evict everything else anyway
+
+            self._items[key] = (value, size, time.time())
+            self._size += size
+
+            while self._size > self._max_size:
+                _, (_, oldsize, _) = self._items.popitem(last=False)
+                self._size -= oldsize
+                self._evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+            self._size -= item[1]
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        """Return a dict of hit/miss/eviction counters and current usage."""
+        with self._lock:
+            return dict(hits=self._hits, misses=self._misses,
+                    evictions=self._evictions, items=len(self._items),
+                    size=self._size, max_size=self._max_size)
+
+    def _staleness(self, item):
+        if self._ttl is None:
+            return 0
+
+        return max(time.time() - item[2] - self._ttl, 0)
+
+if __name__ == "__main__":
+    import doctest; doctest.testmod()
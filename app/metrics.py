@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+"""Lightweight in-process metrics rendered in Prometheus text format.
+
+Counters and histograms are updated under a lock with plain arithmetic, so
+they are cheap enough to stay on in production. Values kept elsewhere (e.g.,
+cache counters) are exported through callbacks evaluated at render time.
+
+Example::
+
+    >>> registry = Registry()
+    >>> hits = registry.counter('hits_total', 'Number of hits.')
+    >>> hits.inc(kind='a')
+    >>> print registry.render(),
+    # HELP hits_total Number of hits.
+    # TYPE hits_total counter
+    hits_total{kind="a"} 1
+
+"""
+
+import time
+import logging
+
+from contextlib import contextmanager
+
+from locks import native_lock
+
+#------------------------------------------------------------------------------
+
+# App logger
+log = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(labels, extra=None):
+    items = sorted(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+            for key, value in items)
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class Counter(object):
+    """Monotonic counter with optional labels."""
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = native_lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        with self._lock:
+            values = self._values.items()
+        return [(self.name, labels, None, value) for labels, value in values]
+
+class Histogram(object):
+    """Distribution of observed values over cumulative buckets."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self._buckets = tuple(sorted(buckets))
+        self._values = {} # labels -> [bucket counts..., sum, count]
+        self._lock = native_lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        nbuckets = len(self._buckets)
+
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (nbuckets + 2)
+
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+
+            counts[nbuckets] += value
+            counts[nbuckets + 1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block in seconds."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def drain(self):
+        """Return ``{labels: counts}`` of values observed so far and forget
+        them, e.g., to :meth:`merge` them in another process."""
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values):
+        """Add values returned by :meth:`drain` of the same histogram."""
+        with self._lock:
+            for key, counts in values.iteritems():
+                mine = self._values.get(key)
+                if mine is None:
+                    self._values[key] = list(counts)
+                else:
+                    for i, count in enumerate(counts):
+                        mine[i] += count
+
+    def totals(self):
+        """Return ``{labels: (count, sum)}`` of observed values, where
+        ``labels`` is a tuple of sorted key/value pairs."""
+        nbuckets = len(self._buckets)
+        with self._lock:
+            return dict((labels, (counts[nbuckets + 1], counts[nbuckets]))
+                    for labels, counts in self._values.items())
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts))
+                    for labels, counts in self._values.items()]
+
+        nbuckets = len(self._buckets)
+        samples = []
+
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', labels,
+                    ('le', _format_value(float(bound))), cumulative))
+            samples.append((self.name + '_bucket', labels, ('le', '+Inf'),
+                counts[nbuckets + 1]))
+            samples.append((self.name + '_sum', labels, None,
+                counts[nbuckets]))
+            samples.append((self.name + '_count', labels, None,
+                counts[nbuckets + 1]))
+
+        return samples
+
+class Callback(object):
+    """Metric whose ``(labels, value)`` samples are returned by ``func`` at
+    render time."""
+
+    def __init__(self, name, help, type, func):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._func = func
+
+    def samples(self):
+        return [(self.name, tuple(sorted(labels)), None, value)
+                for labels, value in self._func()]
+
+#------------------------------------------------------------------------------
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = native_lock()
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def callback(self, name, help, func, type='gauge'):
+        """Export values computed by ``func``, which must return a list of
+        ``(labels, value)`` pairs with ``labels`` as a list of key/value pairs.
+        """
+        return self._register(Callback(name, help, type, func))
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as err:
+                log.error('Cannot collect metric %s: %r', metric.name, err)
+                continue
+
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+
+            for name, labels, extra, value in samples:
+                lines.append('%s%s %s' % (name,
+                    _format_labels(labels, extra), _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+# Global registry
+registry = Registry()
+
+#------------------------------------------------------------------------------
+
+# Metrics shared by the app modules
+
+STAGE_SECONDS = registry.histogram('spritsit_stage_seconds',
+        'Time spent in document processing stages.')
+
+LOCAL_FALLBACKS = registry.counter('spritsit_local_fallback_total',
+        'Extractions that fell back to the local parser.')
+
+RESPONSES = registry.counter('spritsit_responses_total',
+        'Responses by mimetype and compression method.')
+
+REVALIDATIONS = registry.counter('spritsit_revalidations_total',
+        'Conditional requests for sources of expired documents by result.')
+
+if __name__ == "__main__":
+    import doctest; doctest.testmod()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""Page by page text extraction from PDF files with ``pdfminer``.
+
+Pages are laid out and converted one at a time, so only the current page is
+kept in memory; parsed PDF objects aren't cached either, except for fonts.
+Every page is returned as a simple HTML fragment with a paragraph per text
+box, ready for the same cleaning as any other HTML content.
+
+``pdfminer`` is optional: without it :data:`available` is ``False``.
+"""
+
+import cgi
+import logging
+
+#------------------------------------------------------------------------------
+
+# App logger
+log = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+
+try:
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+    from pdfminer.pdftypes import resolve1
+    from pdfminer.converter import PDFPageAggregator
+    from pdfminer.layout import LAParams, LTTextBox, LTFigure
+    available = True
+except ImportError:
+    log.warn('pdfminer is unavailable, PDF files will not be parsed locally.')
+    available = False
+
+#------------------------------------------------------------------------------
+
+def _decode(value):
+    """Return PDF text string ``value`` as unicode."""
+    value = resolve1(value)
+
+    if isinstance(value, unicode):
+        return value
+
+    if not isinstance(value, str):
+        return None
+
+    if value.startswith('\xfe\xff'):
+        return value[2:].decode('utf-16-be', 'replace')
+
+    return value.decode('latin-1')
+
+def _generate_text_boxes(item):
+    for child in item:
+        if isinstance(child, LTTextBox):
+            yield child
+        elif isinstance(child, LTFigure):
+            for box in _generate_text_boxes(child):
+                yield box
+
+class PdfReader(object):
+    """Text content of PDF document read from seekable ``fileobj``.
+    """
+
+    def __init__(self, fileobj):
+        self._parser = PDFParser(fileobj)
+        self._document = PDFDocument(self._parser, caching=False)
+        self._title = self._author = None
+        self._lang = _decode(self._document.catalog.get('Lang'))
+
+        for info in self._document.info:
+            self._title = self._title or _decode(info.get('Title'))
+            self._author = self._author or _decode(info.get('Author'))
+
+    @property
+    def title(self):
+        return self._title
+
+    @property
+    def author(self):
+        return self._author
+
+    @property
+    def lang(self):
+        return self._lang
+
+    def generate_html_pages(self, max_pages=None):
+        """Generate HTML fragment for each of the first ``max_pages`` pages
+        (all pages if ``None``).
+        """
+        resources = PDFResourceManager(caching=True)
+        device = PDFPageAggregator(resources, laparams=LAParams())
+        interpreter = PDFPageInterpreter(resources, device)
+
+        for number, page in enumerate(PDFPage.create_pages(self._document)):
+            if max_pages is not None and number >= max_pages:
+                log.warn('PDF has more than %d pages, the rest is skipped.',
+                        max_pages)
+                break
+
+            interpreter.process_page(page)
+
+            parags = [u' '.join(box.get_text().split())
+                    for box in _generate_text_boxes(device.get_result())]
+
+            yield u''.join(u'<p>%s</p>' % cgi.escape(parag)
+                    for parag in parags if parag)
+
+if __name__ == "__main__":
+    import doctest; doctest.testmod()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""Background refresh of expired documents (*stale-while-revalidate*).
+
+Requests for a recently expired document are answered with the stale copy
+right away, while a small pool of daemon threads extracts it again and puts
+it back to the cache. A key already pending isn't queued twice, and refreshes
+are dropped while too many of them are pending: the next request for the
+document just asks again.
+"""
+
+import Queue
+import logging
+import threading
+
+#------------------------------------------------------------------------------
+
+# App logger
+log = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+
+class Refresher(object):
+    """Run refresh calls in ``workers`` background threads, queueing at most
+    ``max_pending`` of them. Threads are started on the first call.
+
+    Example::
+
+        >>> done = threading.Event()
+        >>> refresher = Refresher(workers=1)
+        >>> refresher.schedule('key', done.set)
+        True
+        >>> done.wait(5)
+        True
+
+    """
+
+    def __init__(self, workers=2, max_pending=100):
+        self._workers = workers
+        self._queue = Queue.Queue(max_pending)
+        self._pending = set()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._scheduled = self._coalesced = self._dropped = 0
+        self._failed = 0
+
+    def schedule(self, key, fn):
+        """Queue ``fn()`` call to refresh ``key`` unless it's pending already
+        or the queue is full; return ``True`` if it's been queued.
+        """
+        with self._lock:
+            if key in self._pending:
+                self._coalesced += 1
+                return False
+
+            try:
+                self._queue.put_nowait((key, fn))
+            except Queue.Full:
+                self._dropped += 1
+                log.warn('Too many pending refreshes, dropping %s', key)
+                return False
+
+            self._pending.add(key)
+            self._scheduled += 1
+
+            self._start_workers()
+
+        return True
+
+    def stats(self):
+        """Return counters of scheduled, coalesced, dropped and failed
+        refreshes."""
+        with self._lock:
+            return dict(scheduled=self._scheduled, coalesced=self._coalesced,
+                    dropped=self._dropped, failed=self._failed,
+                    pending=len(self._pending))
+
+    def _start_workers(self):
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._run,
+                    name='refresher-%d' % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            key, fn = self._queue.get()
+
+            log.debug('Refreshing %s', key)
+
+            try:
+                fn()
+            except Exception as err:
+                log.error('Cannot refresh %s: %r', key, err)
+                with self._lock:
+                    self._failed += 1
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+if __name__ == "__main__":
+    import doctest; doctest.testmod()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""Duplicate call suppression (a.k.a. *single-flight*).
+
+Concurrent callers asking for the same key wait for a single in-flight call
+and share its result. Optionally, calls are also serialized across worker
+processes on the same host with ``flock()``-ed lock files, so that a process
+that waited for another one can pick the result up from a shared cache. Keys
+are hashed onto a fixed set of lock files, so their number stays bounded at
+the cost of unrelated keys sharing a lock now and then.
+"""
+
+import os
+import sys
+import time
+import errno
+import logging
+import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError: # e.g., Google App Engine or Windows
+    fcntl = None
+
+#------------------------------------------------------------------------------
+
+# App logger
+log = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+
+_LOCK_POLL_INTERVAL = 0.05 # seconds
+
+def _lock_file(fileobj):
+    # Poll instead of blocking in flock() so that waiting doesn't stall the
+    # whole process when threads are green (e.g., monkey-patched by gevent)
+    while True:
+        try:
+            fcntl.flock(fileobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except IOError as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        time.sleep(_LOCK_POLL_INTERVAL)
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """Run at most one call per key at a time and share its outcome.
+
+    If ``lock_dir`` is set, the leading call additionally holds an exclusive
+    lock file for the key, one of ``lock_stripes`` files there. Once it gets
+    the lock, ``recheck`` (if given) is called first and its non-``None``
+    result is used instead of calling ``fn``: that's how the work done by
+    another process gets reused.
+
+    Example::
+
+        >>> flight = SingleFlight()
+        >>> flight.do('key', lambda: 42)
+        42
+
+    """
+
+    def __init__(self, lock_dir=None, lock_stripes=64):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._lock_dir = None
+        self._lock_stripes = lock_stripes
+        self._leaders = self._coalesced = self._reused = 0
+
+        if lock_dir and fcntl is None:
+            log.warn('fcntl is unavailable, cross-process locks disabled.')
+        elif lock_dir:
+            try:
+                if not os.path.isdir(lock_dir):
+                    os.makedirs(lock_dir)
+                self._lock_dir = lock_dir
+            except OSError as err:
+                log.error('Cannot create lock dir %s: %r', lock_dir, err)
+
+    def do(self, key, fn, recheck=None):
+        """Return ``fn()``, unless the same ``key`` is already in flight, in
+        which case wait for that call and return (or raise) its outcome.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+
+            if call is not None:
+                self._coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self._leaders += 1
+                leader = True
+
+        if not leader:
+            log.debug('Waiting for in-flight call: %s', key)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = self._run_locked(key, fn, recheck)
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def stats(self):
+        """Return counters of leading, coalesced and reused calls."""
+        with self._lock:
+            return dict(leaders=self._leaders, coalesced=self._coalesced,
+                    reused=self._reused, in_flight=len(self._calls))
+
+    def _run_locked(self, key, fn, recheck):
+        if self._lock_dir is None:
+            return fn()
+
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        stripe = int(digest, 16) % self._lock_stripes
+
+        filename = os.path.join(self._lock_dir, '%03d.lock' % stripe)
+
+        with open(filename, 'a') as flock:
+            _lock_file(flock)
+            try:
+                result = recheck() if recheck else None
+
+                if result is not None:
+                    log.debug('Reusing result of another process: %s', key)
+                    with self._lock:
+                        self._reused += 1
+                    return result
+
+                return fn()
+            finally:
+                fcntl.flock(flock, fcntl.LOCK_UN)
+
+if __name__ == "__main__":
+    import doctest; doctest.testmod()
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import re
+import time
 import urllib2
+import hashlib
 import StringIO
 import logging
 
@@ -9,10 +11,17 @@ try:
 except ImportError: pass
 
 from types import GeneratorType
+from multiprocessing.pool import ThreadPool
 from settings import settings
-from extractor import extractor
+from extractor import extractor, start_process_pool, PAGE_WORDS, \
+        PAGE_PARAGRAPHS
+from doccache import normalize_url
+from lrucache import LRUCache
 
 from lazygen import flat_string_generator, compression_generator
+from lazygen import json_generator
+from tokenizer import tokenize
+from metrics import registry, STAGE_SECONDS, RESPONSES
 
 import fixpath
 
@@ -38,15 +47,84 @@ MAX_TIME_DELTA  = timedelta(days=1)
 
 #-----------------------------------------------------------------------------
 
+class CachedResponse(object):
+    """ Response body serialized in memory along with its headers."""
+
+    def __init__(self, body, mimetype, compression, headers):
+        self.body = body
+        self.mimetype = mimetype
+        self.compression = compression
+        self.headers = dict(headers)
+        self.headers['Content-Length'] = str(len(body))
+        self.etag = hashlib.sha1(body).hexdigest()
+
+    def respond(self, request):
+        """ Return Flask response, or 304 if ``request`` (if given) has a
+        matching ``If-None-Match`` header."""
+
+        RESPONSES.inc(mimetype=self.mimetype,
+                compression=self.compression or 'identity')
+
+        response = Response(self.body,
+            mimetype=self.mimetype,
+            headers=self.headers)
+
+        response.set_etag(self.etag)
+
+        if request is None:
+            return response
+
+        return response.make_conditional(request)
+
+def _create_response_cache(config):
+    if settings.allow_streaming or not config['enabled']:
+        return None
+
+    return LRUCache(config['memory_size'], ttl=config['ttl'],
+            sizeof=lambda response: len(response.body))
+
+# Finished responses when streaming is not allowed
+_response_cache = _create_response_cache(settings.response_cache)
+
+registry.callback('spritsit_response_cache_total',
+        'Response cache hits, misses and evictions.',
+        lambda: [([('event', event)], _response_cache.stats()[event])
+            for event in ['hits', 'misses', 'evictions']]
+            if _response_cache is not None else [],
+        type='counter')
+
+def _response_cache_key(url, fmt, compression):
+    return (normalize_url(url), fmt, compression)
+
+def _get_cached_response(key, request):
+
+    if _response_cache is None:
+        return None
+
+    cached = _response_cache.get(key)
+
+    if cached is None:
+        return None
+
+    log.debug('Serving cached response for %r', key)
+
+    return cached.respond(request)
+
 class ResponseGenerator:
-    """ Convenience wrapper around Flask response."""
+    """ Convenience wrapper around Flask response. Producing the output is
+    timed as serialization, unless it's not ``timed`` (e.g., when documents
+    are extracted while it's produced)."""
 
-    def __init__(self, mimetype, compression=None):
+    def __init__(self, mimetype, compression=None, cache_key=None,
+            timed=True):
         self._mimetype = mimetype
         self._compression = compression
+        self._cache_key = cache_key
+        self._timed = timed
         self._outputs = []
 
-        if mimetype not in ['application/json', 'text/plain']:
+        if mimetype not in ['application/json', 'application/x-ndjson',
+                'text/plain']:
             raise ValueError('Invalid mimetype %r' % mimetype)
 
         self._headers = {
@@ -68,9 +146,23 @@ class ResponseGenerator:
         """ Glue generators into a single one that makes strings."""
         gen = flat_string_generator(self._outputs)
 
+        if self._timed:
+            gen = _timed_generator(gen, 'serialization')
+
         if self._compression:
             log.debug('Compression allowed, method: %s', self._compression)
-            gen = compression_generator(gen, self._compression)
+
+            # Records of NDJSON streams are sent as soon as they're complete,
+            # the next one may take a while to come
+            delimiter = None
+            if self._mimetype == 'application/x-ndjson':
+                delimiter = '\n'
+
+            gen = compression_generator(gen, self._compression,
+                    level=settings.compression['level'],
+                    chunk_size=settings.compression['chunk_size'],
+                    max_delay=settings.compression['max_delay'],
+                    delimiter=delimiter)
 
         if settings.allow_streaming:
             log.info('Streaming is allowed, serializing on the fly.')
@@ -87,12 +179,42 @@ class ResponseGenerator:
 
         return rawstr.getvalue()
 
-    def generate(self):
+    def generate(self, request=None):
+        output = self._get_generator()
+
+        if isinstance(output, basestring): # serialized in memory
+            cached = CachedResponse(output, self._mimetype, self._compression,
+                    self._headers)
+
+            if _response_cache is not None and self._cache_key is not None:
+                _response_cache.put(self._cache_key, cached)
+
+            return cached.respond(request)
+
+        RESPONSES.inc(mimetype=self._mimetype,
+                compression=self._compression or 'identity')
+
         return Response(
-            self._get_generator(),
+            output,
             mimetype=self._mimetype,
             headers=self._headers)
 
+def _timed_generator(gen, stage):
+    """ Yield from ``gen`` and record the time spent producing items."""
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(gen)
+            finally:
+                elapsed += time.time() - start
+            yield item
+    except StopIteration:
+        pass
+    finally:
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+
 def _token_error(token, message):
     errmsg = "Token '{}' is invalid: {}".format(token, message)
     raise ValueError(errmsg)
@@ -132,11 +254,57 @@ def _get_req_url(request):
         logging.error('URL parameter is not found in request')
         abort(400) # bad request
 
+    return _fix_url(url)
+
+def _get_req_page(request):
+    """ Return ``(offset, limit, unit)`` of requested page or ``None``."""
+
+    offset = request.args.get('offset')
+    limit = request.args.get('limit')
+
+    if offset is None and limit is None:
+        return None
+
+    unit = request.args.get('unit', PAGE_WORDS)
+
+    try:
+        offset = int(offset or 0)
+        limit = int(limit or settings.pagination['default_limit'])
+    except ValueError:
+        log.error('Invalid page offset %r or limit %r', offset, limit)
+        abort(400) # bad request
+
+    if (offset < 0 or limit <= 0 or unit not in [PAGE_WORDS, PAGE_PARAGRAPHS]):
+        log.error('Invalid page %r of %r %s', offset, limit, unit)
+        abort(400) # bad request
+
+    return offset, min(limit, settings.pagination['max_limit']), unit
+
+def _fix_url(url):
+
     if not url.startswith('http'):
         url = 'http://' + url;
 
     return url
 
+def _get_req_urls(request):
+
+    urls = request.get_json(force=True, silent=True)
+
+    if isinstance(urls, dict):
+        urls = urls.get('urls')
+
+    if not (isinstance(urls, list) and urls and
+            all(isinstance(url, basestring) and url for url in urls)):
+        log.error('Batch request must hold a non-empty list of URLs')
+        abort(400) # bad request
+
+    if len(urls) > settings.batch['max_urls']:
+        log.error('Too many URLs in batch request: %d', len(urls))
+        abort(413) # request entity too large
+
+    return [_fix_url(url) for url in urls]
+
 def _create_document(url):
 
     # Read raw html
@@ -161,38 +329,219 @@ def _get_compression(accept_encodings):
 
     return None
 
+def _create_stream(url):
+
+    records = extractor.extract_stream(url)
+
+    # Pull the header eagerly so that fetch errors still map to HTTP codes
+    try:
+        header = next(records)
+    except urllib2.URLError as err:
+        log.error('urllib2 URL[%s] error: %s', url, err)
+        abort(400) # bad request
+
+    return _stream_generator(header, records)
+
+def _stream_generator(header, records):
+
+    yield json_generator(header)
+    yield '\n'
+
+    try:
+        for record in records:
+            yield json_generator(record)
+            yield '\n'
+    except Exception as err:
+        log.exception('Streaming extraction failed')
+        yield json_generator(dict(type='error', error=repr(err)))
+        yield '\n'
+
+def _get_json_stream(request):
+
+    records = _create_stream(_get_req_url(request))
+
+    compression = _get_compression(
+        request.headers.get('accept-encoding', ''))
+
+    # Records are extracted while they're serialized
+    response = ResponseGenerator('application/x-ndjson', compression,
+            timed=False)
+
+    response.add_output(records)
+
+    return response.generate()
+
 def _get_json(request):
 
     _validate_token(request)
 
-    doc = _create_document(_get_req_url(request))
+    if request.args.get('stream'):
+        return _get_json_stream(request)
+
+    url = _get_req_url(request)
 
     compression = _get_compression(
         request.headers.get('accept-encoding', ''))
 
-    response = ResponseGenerator('application/json', compression)
-
     jsonp = request.args.get('callback')
 
-    if jsonp:
-        log.debug('JSONP is enabled');
-        response.add_output("%s(" % jsonp)
+    tokens = bool(request.args.get('tokens'))
 
-    response.add_output(doc.json_generator())
+    page = _get_req_page(request)
 
     if jsonp:
-        response.add_output(")")
+        return _get_jsonp(request, url, jsonp, compression, tokens, page)
+
+    cache_key = _response_cache_key(url, ('json', tokens, page),
+            compression)
+
+    cached = _get_cached_response(cache_key, request)
+
+    if cached is not None:
+        return cached
+
+    doc = _create_document(url)
+
+    # Don't keep responses of stale documents beyond their refresh
+    if doc.is_stale():
+        cache_key = None
+
+    response = ResponseGenerator('application/json', compression, cache_key)
+
+    response.add_output(_json_output(doc, tokens, page))
+
+    return response.generate(request)
+
+def _get_jsonp(request, url, jsonp, compression, tokens, page):
+    """ Return JSON wrapped in ``jsonp`` callback call. Callback names change
+    with every request (e.g., jQuery makes them up), so it's JSON that's
+    cached, uncompressed: it's wrapped and compressed for each response."""
+
+    log.debug('JSONP is enabled');
+
+    cache_key = _response_cache_key(url, ('json', tokens, page), None)
+
+    cached = None
+
+    if _response_cache is not None:
+        cached = _response_cache.get(cache_key)
+
+    if cached is not None:
+        log.debug('Serving cached JSON for %r', cache_key)
+        body = cached.body
+    else:
+        doc = _create_document(url)
+        body = _json_output(doc, tokens, page)
+
+        if _response_cache is not None and not doc.is_stale():
+            body = _cache_json(cache_key, body)
+
+    # Only wrapping the body is left to serialize, if it's cached
+    response = ResponseGenerator('application/json', compression,
+            timed=not isinstance(body, basestring))
+
+    response.add_output("%s(" % jsonp)
+    response.add_output(body)
+    response.add_output(")")
+
+    return response.generate(request)
+
+def _json_output(doc, tokens, page):
+    """ Return JSON generator for ``doc`` or for its ``page``."""
+
+    if page:
+        return _page_generator(doc, page, tokens)
+
+    return doc.json_generator(tokens)
+
+def _cache_json(cache_key, output):
+    """ Return JSON ``output`` serialized, caching it under ``cache_key``."""
+
+    body = ''.join(_timed_generator(flat_string_generator([output]),
+            'serialization'))
+
+    headers = {'Content-Type': 'application/json; charset=utf-8'}
+
+    _response_cache.put(cache_key, CachedResponse(body, 'application/json',
+            None, headers))
+
+    return body
 
-    return response.generate()
 
+def _page_generator(doc, page, tokens):
+    """ Return JSON generator for a page of ``doc``."""
+
+    json_object = doc.get_page(*page)
+
+    if tokens:
+        json_object['tokens'] = tokenize(json_object['content'].split('\n'),
+                doc.direction or 'ltr')
+
+    return json_generator(json_object)
+
+def _extract_batch_item(url):
+    """Return JSON dict with either extracted document or error details."""
+
+    try:
+        return dict(url=url, document=extractor.extract(url).to_json())
+    except urllib2.HTTPError as err:
+        log.error('urllib2 HTTP error for %s: %s', url, err)
+        return dict(url=url, error=str(err), code=err.code)
+    except urllib2.URLError as err:
+        log.error('urllib2 URL[%s] error: %s', url, err)
+        return dict(url=url, error=str(err.reason), code=400)
+    except Exception as err:
+        log.exception('Extraction failed for %s', url)
+        return dict(url=url, error=repr(err), code=500)
+
+def _batch_generator(urls):
+    """Extract ``urls`` concurrently, yield NDJSON lines as they complete."""
+
+    pool = ThreadPool(min(settings.batch['workers'], len(urls)))
+
+    try:
+        for item in pool.imap_unordered(_extract_batch_item, urls):
+            yield json_generator(item)
+            yield '\n'
+    finally:
+        pool.terminate()
+
+def _get_batch(request):
+
+    _validate_token(request)
+
+    urls = _get_req_urls(request)
+
+    compression = _get_compression(
+        request.headers.get('accept-encoding', ''))
+
+    # Documents are extracted while they're serialized
+    response = ResponseGenerator('application/x-ndjson', compression,
+            timed=False)
+
+    response.add_output(_batch_generator(urls))
+
+    return response.generate()
 
 def _get_text(request):
 
     _validate_token(request)
 
-    doc = _create_document(_get_req_url(request))
+    url = _get_req_url(request)
+
+    cache_key = _response_cache_key(url, 'text', None)
 
-    response = ResponseGenerator('text/plain')
+    cached = _get_cached_response(cache_key, request)
+
+    if cached is not None:
+        return cached
+
+    doc = _create_document(url)
+
+    if doc.is_stale():
+        cache_key = None
+
+    response = ResponseGenerator('text/plain', cache_key=cache_key)
 
     for field in ['title', 'url', 'content']:
         value = getattr(doc,field)
@@ -202,7 +551,7 @@ def _get_text(request):
         response.add_output(value)
         response.add_output('\n\n')
 
-    return response.generate()
+    return response.generate(request)
 
 def _log_env():
     log.info('Current version: %s', settings.app_version)
@@ -224,6 +573,9 @@ def _startup():
 
     _urllib_config()
 
+    # Fork ePub parsing workers while there are no other threads
+    start_process_pool()
+
 #-----------------------------------------------------------------------------
 
 from flask import Flask
@@ -264,6 +616,15 @@ def json():
 def text():
     return _get_text(flask_request)
 
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(),
+            mimetype='text/plain; version=0.0.4')
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    return _get_batch(flask_request)
+
 def run(port, debug):
     app.run(host='0.0.0.0', port=port, debug=debug)
 
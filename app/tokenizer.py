@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""Word tokenization and optimal recognition point (ORP) precomputation.
+
+Mirrors ``words_set()`` and ``word_show()`` of ``static/js/index.js`` so
+that clients may take the words and their pivots from the server instead of
+re-splitting the text and matching regexes for every word shown.
+
+Example::
+
+    >>> tokens = tokenize([u'Hello, world!', u'Bye'])
+    >>> print u'|'.join(tokens['words']).replace(PAUSE, '<pause>')
+    Hello,|world!|<pause>|Bye
+    >>> tokens['pivot'], tokens['start'], tokens['end']
+    ([1, 1, -1, 1], [0, 0, 0, 0], [5, 5, 0, 3])
+    >>> tokens['paragraphs']
+    [0, 3]
+
+"""
+
+import re
+
+#------------------------------------------------------------------------------
+
+# Pause marker inserted after trailing punctuation
+PAUSE = u'⁋'
+
+_PUNCTN = ur'[\"\'\,\.\!\?\:\;\*\~\+\-_¡¿‘’“”«»„\[\]\(\)\{\}…©®™]+'
+
+_regex = {
+    'dashes': re.compile(ur'([‐-—])(\S)', flags=re.UNICODE),
+    'hyphens': re.compile(ur'(\S)\-(\S)', flags=re.UNICODE),
+    'trailing': re.compile(
+        ur'([\"\'\.\!\?\:\;\*\~\+\-_¡¿‘’“”«»„\[\]\(\)\{\}…©®™]+)\s',
+        flags=re.UNICODE),
+    'spaces': re.compile(ur'\s+', flags=re.UNICODE),
+    'begin': re.compile(ur'^' + _PUNCTN, flags=re.UNICODE),
+    'end': re.compile(_PUNCTN + ur'$', flags=re.UNICODE),
+    # In RTL digits and non-RTL words run LTR (ASCII classes, as in JS)
+    'inverse_rtl': re.compile(ur'^[0-9A-Za-z_٠-٬\.\,]+$'),
+}
+
+def split_words(text):
+    """Split ``text`` into words the way the client does, with a
+    :data:`PAUSE` marker after each word with trailing punctuation.
+    """
+    text = _regex['dashes'].sub(ur'\1 \2', text)
+    text = _regex['hyphens'].sub(ur'\1- \2', text)
+    text = _regex['trailing'].sub(ur'\1 %s ' % PAUSE, text)
+
+    return [word for word in _regex['spaces'].split(text) if word]
+
+def word_pivot(word, rtl=False):
+    """Return ``(pivot, start, end, inverted)`` tuple for ``word``.
+
+    ``start`` and ``end`` bound the word without its leading and trailing
+    punctuation, ``pivot`` is the index of the character to focus on (``-1``
+    if there's none to show) and ``inverted`` tells if it's a left-to-right
+    run within right-to-left text, which is shown reversed.
+    """
+    if word == PAUSE:
+        return -1, 0, 0, False
+
+    start = 0
+    match = _regex['begin'].match(word)
+    if match:
+        start = match.end()
+
+    end = len(word)
+    match = _regex['end'].search(word)
+    if match:
+        end = match.start()
+
+    length = end - start
+
+    if length <= 0:
+        return -1, start, end, False
+
+    stop = int((length + 1) * 0.4 + 0.5) - 1 # as Math.round()
+
+    if rtl and _regex['inverse_rtl'].match(word[start:end]):
+        return end - stop - 1, start, end, True
+
+    return stop + start, start, end, False
+
+def _split_paragraphs(paragraphs):
+    """Yield ``(index, words)`` for every non-blank paragraph, where
+    ``index`` is its position in ``paragraphs``.
+    """
+    nonblank = [(i, parag.strip()) for i, parag in enumerate(paragraphs)
+            if parag.strip()]
+
+    for n, (i, parag) in enumerate(nonblank):
+        if n + 1 < len(nonblank):
+            parag += u' ' # paragraphs are joined with spaces by the client
+
+        yield i, split_words(parag)
+
+def tokenize(paragraphs, direction='ltr'):
+    """Return dictionary of parallel arrays for words of ``paragraphs``:
+
+    - ``words``: words as the client splits them;
+    - ``pivot``: per-word pivot index (``-1`` for words not to be shown);
+    - ``start``, ``end``: per-word span without surrounding punctuation;
+    - ``paragraphs``: index of the first word of each paragraph;
+    - ``inverted``: indexes of words shown reversed in RTL text.
+    """
+    rtl = direction == 'rtl'
+
+    tokens = dict(words=[], pivot=[], start=[], end=[], paragraphs=[],
+            inverted=[])
+
+    for _, words in _split_paragraphs(paragraphs):
+        tokens['paragraphs'].append(len(tokens['words']))
+
+        for word in words:
+            pivot, start, end, inverted = word_pivot(word, rtl)
+
+            if inverted:
+                tokens['inverted'].append(len(tokens['words']))
+
+            tokens['words'].append(word)
+            tokens['pivot'].append(pivot)
+            tokens['start'].append(start)
+            tokens['end'].append(end)
+
+    return tokens
+
+def word_offsets(paragraphs):
+    """Return ``(offsets, total)``, where ``offsets`` is the list of
+    ``(index, offset)`` pairs for non-blank paragraphs: position of the
+    paragraph in ``paragraphs`` and the index of its first word among the
+    ``total`` words as they are counted by :func:`tokenize`.
+
+    Example::
+
+        >>> word_offsets([u'One two.', u'', u'Three'])
+        ([(0, 0), (2, 3)], 4)
+
+    """
+    offsets = []
+    total = 0
+
+    for i, words in _split_paragraphs(paragraphs):
+        offsets.append((i, total))
+        total += len(words)
+
+    return offsets, total
+
+if __name__ == "__main__":
+    import doctest; doctest.testmod()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""Regenerate benchmark fixtures in ``corpus/``.
+
+The corpus is checked in, so this only needs to run when fixtures change.
+Text is produced by a seeded pseudo-random generator, which keeps fixtures
+deterministic while giving a realistic mix of short words, punctuation and
+long compounds that exercise hyphenation.
+
+Usage::
+
+    python make_corpus.py
+
+"""
+
+import json
+import random
+import zipfile
+
+from os import path
+
+CORPUS_DIR = path.join(path.dirname(path.abspath(__file__)), 'corpus')
+
+_WORDS = u'''the of and to in is that it was for on are as with his they at be
+this from have or by one had not but what all were when we there can an your
+which their said if do will each about how up out them then she many some so
+these would other into has more her two like him see time could no make than
+first been its who now people my made over did down only way find use may water
+long little very after words called just where most know get through back much
+before go good new write our used me man too any day same right look think also
+around another came come work three word must because does part even place well
+such here take why things help put years different away again off went old
+number reading speed article paragraph sentence language hyphenation
+'''.split()
+
+_LONG_WORDS = u'''extraordinarily incomprehensibilities internationalization
+counterrevolutionaries Donaudampfschifffahrtsgesellschaft
+Rechtsschutzversicherungsgesellschaften Lebensversicherungsgesellschaft
+epäjärjestelmällistyttämättömyydellänsäkään characterization
+'''.split()
+
+_PUNCTUATION = [u',', u',', u';', u' --', u':']
+
+def _sentence(rnd):
+    words = []
+    for i in range(rnd.randint(6, 24)):
+        word = rnd.choice(_LONG_WORDS if rnd.random() < 0.04 else _WORDS)
+        if i and rnd.random() < 0.08:
+            word += rnd.choice(_PUNCTUATION)
+        words.append(word)
+    words[0] = words[0].capitalize()
+    return u' '.join(words) + rnd.choice([u'.', u'.', u'.', u'!', u'?'])
+
+def _paragraph(rnd):
+    return u' '.join(_sentence(rnd) for _ in range(rnd.randint(2, 8)))
+
+def _article_body(rnd, paragraphs):
+    parts = []
+    for i in range(paragraphs):
+        if i % 12 == 0:
+            parts.append(u'<h2>%s</h2>' % _sentence(rnd).rstrip(u'.!?'))
+        text = _paragraph(rnd)
+        if rnd.random() < 0.3:
+            words = text.split(u' ')
+            k = rnd.randrange(len(words))
+            words[k] = u'<em>%s</em>' % words[k]
+            words[k-1] = words[k-1] + u'<br/>'
+            text = u' '.join(words)
+        parts.append(u'<p>%s</p>' % text)
+    return u'\n'.join(parts)
+
+_PAGE = u'''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>%(title)s | The Benchmark Times</title>
+<style>body { font-family: serif; } .nav li { display: inline; }</style>
+<script>var analytics = {"id": "UA-0000000-0", "events": []};</script>
+</head>
+<body>
+<ul class="nav"><li><a href="/">Home</a></li><li><a href="/world">World</a></li>
+<li><a href="/tech">Tech</a></li><li><a href="/about">About</a></li></ul>
+<div id="sidebar"><h3>Most read</h3><ul>%(sidebar)s</ul></div>
+<div id="article" class="article-content">
+<h1>%(title)s</h1>
+<p class="byline">By Jane Doe</p>
+%(body)s
+</div>
+<div id="comments"><h3>Comments</h3>%(comments)s</div>
+<div id="footer">&copy; The Benchmark Times</div>
+</body>
+</html>
+'''
+
+def make_article(rnd):
+    title = _sentence(rnd).rstrip(u'.!?')
+    sidebar = u''.join(u'<li><a href="/%d">%s</a></li>' % (i, _sentence(rnd))
+            for i in range(10))
+    comments = u''.join(u'<div class="comment"><b>user%d</b> %s</div>' % (
+        i, _sentence(rnd)) for i in range(20))
+    body = _article_body(rnd, 160)
+    return title, body, _PAGE % dict(title=title, sidebar=sidebar,
+            body=body, comments=comments)
+
+def make_readability_json(title, body):
+    content = u'<div><div>%s</div></div>' % body
+    return dict(
+        url='http://bench.local/article.html',
+        domain='bench.local',
+        title=title,
+        author='Jane Doe',
+        content=content,
+        excerpt=content[:200],
+        word_count=len(body.split()),
+        direction='ltr',
+        total_pages=0,
+        rendered_pages=1,
+        next_page_id=None,
+        lead_image_url=None,
+        date_published=None,
+        dek=None)
+
+_CONTAINER = '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+'''
+
+_OPF = u'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="id">bench-book</dc:identifier>
+    <dc:title>The Benchmark Book</dc:title>
+    <dc:creator>Jane Doe</dc:creator>
+    <dc:language>en</dc:language>
+  </metadata>
+  <manifest>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+%(items)s
+  </manifest>
+  <spine toc="ncx">
+%(itemrefs)s
+  </spine>
+</package>
+'''
+
+_NCX = u'''<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head><meta name="dtb:uid" content="bench-book"/></head>
+  <docTitle><text>The Benchmark Book</text></docTitle>
+  <navMap>
+%(points)s
+  </navMap>
+</ncx>
+'''
+
+_CHAPTER = u'''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>Chapter %(n)d</title></head>
+<body><div><h1>Chapter %(n)d</h1>
+%(body)s
+</div></body>
+</html>
+'''
+
+_EPOCH = (2014, 4, 18, 0, 0, 0) # fixed timestamps keep the zip reproducible
+
+def _writestr(book, name, data, compress_type=zipfile.ZIP_DEFLATED):
+    info = zipfile.ZipInfo(name, date_time=_EPOCH)
+    info.compress_type = compress_type
+    book.writestr(info, data)
+
+def make_epub(rnd, filename, chapters=12):
+    items, itemrefs, points = [], [], []
+
+    with zipfile.ZipFile(filename, 'w') as book:
+        _writestr(book, 'mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
+        _writestr(book, 'META-INF/container.xml', _CONTAINER)
+
+        for n in range(1, chapters + 1):
+            href = 'chapter%02d.xhtml' % n
+            items.append(u'    <item id="ch%d" href="%s" '
+                    u'media-type="application/xhtml+xml"/>' % (n, href))
+            itemrefs.append(u'    <itemref idref="ch%d"/>' % n)
+            points.append(u'    <navPoint id="np%d" playOrder="%d"><navLabel>'
+                    u'<text>Chapter %d</text></navLabel><content src="%s"/>'
+                    u'</navPoint>' % (n, n, n, href))
+            chapter = _CHAPTER % dict(n=n, body=_article_body(rnd, 40))
+            _writestr(book, 'OEBPS/' + href, chapter.encode('utf-8'))
+
+        _writestr(book, 'OEBPS/content.opf', (_OPF % dict(
+            items=u'\n'.join(items), itemrefs=u'\n'.join(itemrefs)
+            )).encode('utf-8'))
+        _writestr(book, 'OEBPS/toc.ncx', (_NCX % dict(
+            points=u'\n'.join(points))).encode('utf-8'))
+
+def main():
+    rnd = random.Random(20140418)
+
+    title, body, page = make_article(rnd)
+
+    with open(path.join(CORPUS_DIR, 'article.html'), 'wb') as fout:
+        fout.write(page.encode('utf-8'))
+
+    with open(path.join(CORPUS_DIR, 'readability.json'), 'wb') as fout:
+        json.dump(make_readability_json(title, body), fout, indent=1,
+                sort_keys=True)
+
+    make_epub(rnd, path.join(CORPUS_DIR, 'book.epub'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the extraction and serialization hot paths.
+
+Every stage runs against the fixtures in ``corpus/``; end-to-end stages
+fetch them from a local stub HTTP server that plays both the Readability
+API and the source site, so no network access is needed. Results are
+written as JSON, which makes runs on different commits comparable.
+
+Usage::
+
+    python run_bench.py [-n REPEAT] [-o results.json] [-c baseline.json]
+                        [-v] [STAGE ...]
+
+Memory is measured by running each stage once more in a fresh process: the
+growth of its peak RSS over the RSS before the run, one-time costs such as
+loading dictionaries included, is what the stage needs. On Linux the peak is
+reset before the run; elsewhere only growth beyond the peak of the bench
+setup is seen. Memory of child processes (e.g., the ePub pool) isn't counted.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import gzip
+import logging
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from os import path
+from StringIO import StringIO
+
+BENCH_DIR  = path.dirname(path.abspath(__file__))
+CORPUS_DIR = path.join(BENCH_DIR, 'corpus')
+APP_DIR    = path.join(BENCH_DIR, os.pardir, 'app')
+
+sys.path.insert(0, APP_DIR)
+
+# The app refuses to start without a key; the stub server doesn't check it.
+os.environ.setdefault('READABILITY_API_KEY', 'bench')
+
+import lazygen
+import extractor as extractor_module
+
+from lazygen import gunzip_generator
+
+from readability import readability
+
+#------------------------------------------------------------------------------
+
+def _read_fixture(name):
+    with open(path.join(CORPUS_DIR, name), 'rb') as fin:
+        return fin.read()
+
+def _gzip(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+        gz.write(data)
+    return buf.getvalue()
+
+class Corpus(object):
+
+    def __init__(self):
+        self.article_html = _read_fixture('article.html')
+        self.rdd_json = _read_fixture('readability.json')
+        self.rdd_json_gz = _gzip(self.rdd_json)
+        self.epub = _read_fixture('book.epub')
+        self.rdd_content = json.loads(self.rdd_json)['content']
+
+        # Decompressed chunks, as the extractor sees HTTP responses
+        self.rdd_chunks = list(gunzip_generator(StringIO(self.rdd_json_gz)))
+        self.html_chunks = list(gunzip_generator(StringIO(
+            _gzip(self.article_html))))
+
+        self._clean_doc = self._words = None
+
+    @property
+    def clean_doc(self):
+        # Made on demand, so that it doesn't count in memory of other stages
+        if self._clean_doc is None:
+            doc = extractor_module.CleanDocument('http://bench.local/')
+            doc.content = self.rdd_content
+            doc.textify()
+            self._clean_doc, self._words = doc, doc.content.split()
+        return self._clean_doc
+
+    @property
+    def words(self):
+        self.clean_doc
+        return self._words
+
+#------------------------------------------------------------------------------
+
+class _StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves ``corpus/`` files; ``/rdd?url=...`` mimics the Readability API
+    for source URLs containing ``rdd``, and fails for others.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        corpus = self.server.corpus
+        parts = urlparse.urlsplit(self.path)
+
+        if parts.path == '/rdd':
+            source = urlparse.parse_qs(parts.query).get('url', [''])[0]
+            if 'rdd' in source:
+                self._send(200, 'application/json', corpus.rdd_json_gz, 'gzip')
+            else:
+                self._send(404, 'application/json', '{"error": "true"}')
+        elif parts.path.endswith('.html'):
+            self._send(200, 'text/html; charset=utf-8', corpus.article_html)
+        elif parts.path.endswith('.epub'):
+            self._send(200, 'application/epub+zip', corpus.epub)
+        else:
+            self._send(404, 'text/plain', 'not found')
+
+    def _send(self, code, content_type, body, encoding=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass # clients dropping keep-alive connections are expected
+
+def start_stub_server(corpus):
+    server = _StubServer(('127.0.0.1', 0), _StubHandler)
+    server.corpus = corpus
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+def create_extractor(base_url):
+    extractor = extractor_module.Extractor()
+
+    # Talk to the stub and measure the real work, not cache lookups
+    extractor._rdd_api_url = base_url + '/rdd'
+    extractor._cache = None
+
+    return extractor
+
+#------------------------------------------------------------------------------
+
+# Stage functions take the bench context and return ``{unit: amount}`` of
+# work done per run, which gives the throughput figures.
+
+STAGES = []
+
+def stage(func):
+    STAGES.append((func.__name__.replace('bench_', '', 1), func))
+    return func
+
+def on_clean_doc(func):
+    """Mark stage working on the textified corpus document, which is made
+    before measuring memory of the stage then."""
+    func.on_clean_doc = True
+    return func
+
+@stage
+def bench_textify(ctx):
+    doc = extractor_module.CleanDocument('http://bench.local/')
+    doc.content = ctx.corpus.rdd_content
+    doc.textify()
+    return dict(words=doc.word_count)
+
+@stage
+def bench_textify_lang_hint(ctx):
+    # Same as textify but for language guessing, see check_lang_guess()
+    doc = extractor_module.CleanDocument('http://bench.local/',
+            lang_hint='en')
+    doc.content = ctx.corpus.rdd_content
+    doc.textify()
+    return dict(words=doc.word_count)
+
+@stage
+@on_clean_doc
+def bench_clean_word(ctx):
+    doc = extractor_module.CleanDocument('http://bench.local/')
+    for word in ctx.corpus.words:
+        doc._clean_word(word)
+    return dict(words=len(ctx.corpus.words))
+
+@stage
+def bench_readability_summary(ctx):
+    rawhtml = ctx.corpus.article_html
+    readability.Document(rawhtml).summary()
+    return dict(bytes=len(rawhtml))
+
+def _serialized_doc(ctx):
+    return lazygen.flat_string_generator(
+            [ctx.corpus.clean_doc.json_generator()])
+
+@stage
+@on_clean_doc
+def bench_json_serialize(ctx):
+    size = sum(len(chunk) for chunk in _serialized_doc(ctx))
+    return dict(bytes=size)
+
+@stage
+@on_clean_doc
+def bench_doc_store_json(ctx):
+    data = json.dumps(ctx.corpus.clean_doc.to_json())
+    doc = extractor_module.CleanDocument.from_json(json.loads(data))
+    return dict(bytes=len(data), words=doc.word_count)
+
+@stage
+@on_clean_doc
+def bench_doc_store_packed(ctx):
+    data = ctx.corpus.clean_doc.to_bytes()
+    doc = extractor_module.CleanDocument.from_bytes(data)
+    return dict(bytes=len(data), words=doc.word_count)
+
+@stage
+@on_clean_doc
+def bench_gzip_generator(ctx):
+    size = sum(len(chunk) for chunk in
+            lazygen.gzip_generator(_serialized_doc(ctx)))
+    return dict(bytes=len(ctx.corpus.rdd_json), output_bytes=size)
+
+@stage
+@on_clean_doc
+def bench_deflate_generator(ctx):
+    size = sum(len(chunk) for chunk in
+            lazygen.deflate_generator(_serialized_doc(ctx)))
+    return dict(bytes=len(ctx.corpus.rdd_json), output_bytes=size)
+
+@stage
+def bench_string_gen_stream(ctx):
+    gunzip = lazygen.gunzip_generator(StringIO(ctx.corpus.rdd_json_gz))
+    json.load(lazygen.StringGenStream(gunzip))
+    return dict(bytes=len(ctx.corpus.rdd_json))
+
+class _LegacyStringGenStream(object):
+    """``StringGenStream`` as it was before the bytearray rewrite, kept as the
+    baseline for its micro-benchmarks.
+    """
+
+    def __init__(self, string_generator):
+        self._string_generator = string_generator
+        self._accumulator = None
+
+    def read(self, n=-1):
+        if self._accumulator is None:
+            self._accumulator = StringIO()
+
+        if n is None or n < 0:
+            n = sys.maxsize
+
+        buffer = []
+
+        while n > 0:
+            nextstr = self._accumulator.read(n)
+
+            if nextstr:
+                buffer.append(nextstr)
+                n = n - len(nextstr)
+            else:
+                try:
+                    nextstr = next(self._string_generator)
+                    self._accumulator = StringIO(nextstr)
+                except StopIteration:
+                    n = 0
+
+        return ''.join(buffer)
+
+def _read_chunked(stream, size=1024):
+    total = 0
+    while True:
+        data = stream.read(size)
+        if not data:
+            return total
+        total += len(data)
+
+@stage
+def bench_string_gen_stream_chunked(ctx):
+    # Reads in blocks spanning generated strings, as lxml parsers do
+    chunks = ctx.corpus.rdd_chunks
+    size = _read_chunked(lazygen.StringGenStream(iter(chunks)))
+    return dict(bytes=size)
+
+@stage
+def bench_string_gen_stream_chunked_legacy(ctx):
+    chunks = ctx.corpus.rdd_chunks
+    size = _read_chunked(_LegacyStringGenStream(iter(chunks)))
+    return dict(bytes=size)
+
+@stage
+def bench_string_gen_stream_readinto(ctx):
+    stream = lazygen.StringGenStream(iter(ctx.corpus.rdd_chunks))
+    buf = bytearray(1024)
+    size = 0
+    while True:
+        count = stream.readinto(buf)
+        if not count:
+            break
+        size += count
+    return dict(bytes=size)
+
+@stage
+def bench_string_gen_stream_readline(ctx):
+    stream = lazygen.StringGenStream(iter(ctx.corpus.html_chunks))
+    size = sum(len(line) for line in stream)
+    return dict(bytes=size)
+
+@stage
+def bench_extract_readability(ctx):
+    doc = ctx.extractor.extract(ctx.base_url + '/rdd-article.html')
+    return dict(words=doc.word_count)
+
+@stage
+def bench_extract_html(ctx):
+    doc = ctx.extractor.extract(ctx.base_url + '/article.html')
+    return dict(words=doc.word_count)
+
+@stage
+def bench_extract_epub(ctx):
+    doc = ctx.extractor.extract(ctx.base_url + '/book.epub')
+    return dict(words=doc.word_count)
+
+#------------------------------------------------------------------------------
+
+def _maxrss_kb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 if sys.platform == 'darwin' else maxrss
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+class _Context(object):
+    pass
+
+def _create_context():
+    ctx = _Context()
+    ctx.corpus = Corpus()
+    ctx.base_url = start_stub_server(ctx.corpus)
+    ctx.extractor = create_extractor(ctx.base_url)
+    return ctx
+
+def _proc_status_kb(key):
+    with open('/proc/self/status') as fin:
+        for line in fin:
+            if line.startswith(key + ':'):
+                return int(line.split()[1])
+
+def _reset_peak_rss():
+    """Reset peak RSS of this process to the current one; return ``False``
+    if it isn't supported (it's Linux only).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fout:
+            fout.write('5')
+        return True
+    except IOError:
+        return False
+
+def measure_stage_memory(name):
+    """Print JSON of peak RSS in kB of a single run of stage ``name`` in this
+    process and of its growth over the RSS before the run.
+    """
+    func = dict(STAGES)[name]
+
+    ctx = _create_context()
+
+    if getattr(func, 'on_clean_doc', False):
+        ctx.corpus.clean_doc
+
+    gc.collect()
+
+    if _reset_peak_rss():
+        before = _proc_status_kb('VmRSS')
+        func(ctx)
+        peak = _proc_status_kb('VmHWM')
+    else:
+        before = _maxrss_kb()
+        func(ctx)
+        peak = _maxrss_kb()
+
+    print json.dumps(dict(peak_rss_kb=peak, rss_growth_kb=peak - before))
+
+def run_stage_memory(name):
+    """Return memory figures of stage ``name`` run in a fresh process, see
+    :func:`measure_stage_memory`, or an empty dict if it fails.
+    """
+    command = [sys.executable, path.abspath(__file__), '--memory', name]
+
+    try:
+        output = subprocess.check_output(command)
+    except (OSError, subprocess.CalledProcessError) as err:
+        print 'Cannot measure memory of %s: %s' % (name, err)
+        return {}
+
+    return json.loads(output.strip().splitlines()[-1])
+
+def run_stage(func, ctx, repeat):
+    func(ctx) # warm up caches, imports and connections
+
+    timings = []
+
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        units = func(ctx)
+        timings.append(time.time() - start)
+
+    median = _median(timings)
+
+    result = dict(runs=repeat,
+            min_s=min(timings),
+            median_s=median,
+            mean_s=sum(timings) / len(timings))
+
+    for unit, amount in units.items():
+        result[unit] = amount
+        if not unit.startswith('output_') and median > 0:
+            result[unit + '_per_s'] = amount / median
+
+    return result
+
+# Language guessing may take that share of textify time at most
+LANG_GUESS_MAX_SHARE = 0.25
+
+def check_lang_guess(results):
+    """Print time language guessing adds to textify, warning if it's more
+    than :data:`LANG_GUESS_MAX_SHARE` of it."""
+
+    textify = results['stages'].get('textify')
+    hinted = results['stages'].get('textify_lang_hint')
+
+    if not (textify and hinted):
+        return
+
+    overhead = textify['median_s'] - hinted['median_s']
+    share = overhead / textify['median_s']
+
+    print '\nLanguage guessing takes %.2f ms, %.0f%% of textify%s' % (
+            overhead * 1000, share * 100,
+            ' (TOO SLOW)' if share > LANG_GUESS_MAX_SHARE else '')
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=BENCH_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    print '\n%-32s %12s %12s %8s' % ('stage', 'base, ms', 'this, ms', 'ratio')
+
+    for name, result in sorted(results['stages'].items()):
+        base = baseline['stages'].get(name)
+        if not base:
+            continue
+        print '%-32s %12.2f %12.2f %8.2f' % (name, base['median_s'] * 1000,
+                result['median_s'] * 1000,
+                result['median_s'] / base['median_s'])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('stages', nargs='*', metavar='STAGE',
+            help='stages to run (default: all of %s)' % ', '.join(
+                name for name, _ in STAGES))
+    parser.add_argument('-n', '--repeat', type=int, default=10)
+    parser.add_argument('-o', '--output', help='write JSON results here')
+    parser.add_argument('-c', '--compare', help='baseline JSON results')
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help='show app log messages')
+    parser.add_argument('--memory', metavar='STAGE', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+            level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    # Fork ePub parsing workers before the stub server thread is started
+    extractor_module.start_process_pool()
+
+    if args.memory:
+        measure_stage_memory(args.memory)
+        return
+
+    ctx = _create_context()
+
+    results = dict(meta=dict(
+        revision=_git_revision(),
+        python=platform.python_version(),
+        timestamp=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        repeat=args.repeat), stages={})
+
+    for name, func in STAGES:
+        if args.stages and name not in args.stages:
+            continue
+
+        result = run_stage(func, ctx, args.repeat)
+        result.update(run_stage_memory(name))
+        results['stages'][name] = result
+
+        print '%-32s median %9.2f ms  min %9.2f ms  rss +%d kB' % (name,
+                result['median_s'] * 1000, result['min_s'] * 1000,
+                result.get('rss_growth_kb', 0))
+
+    check_lang_guess(results)
+
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fin:
+            compare(results, json.load(fin))
+
+if __name__ == '__main__':
+    main()
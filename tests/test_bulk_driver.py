@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the bulk extraction driver.
+
+Run from the project root with ``python -m unittest discover tests``.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+from os import path
+
+ROOT_DIR = path.join(path.dirname(path.abspath(__file__)), os.pardir)
+
+sys.path.insert(0, path.join(ROOT_DIR, 'app'))
+
+# The app refuses to start without a key, it's never used here
+os.environ.setdefault('READABILITY_API_KEY', 'test')
+
+import bulk_driver
+import extractor
+
+from doccache import DocumentCache
+from extractor import CleanDocument
+
+#------------------------------------------------------------------------------
+
+EPUB_FILE = path.join(ROOT_DIR, 'bench', 'corpus', 'book.epub')
+
+class _EpubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with open(EPUB_FILE, 'rb') as fin:
+            body = fin.read()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/epub+zip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass # clients dropping keep-alive connections are expected
+
+class BulkDriverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _EpubHandler)
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = path.join(self.tmp_dir, 'store.sqlite')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_epub_in_worker_processes(self):
+        # Worker processes must parse chapters themselves, whether or not
+        # this process has a pool for that
+        extractor.start_process_pool()
+
+        urls = ['%s/%d/book.epub' % (self.base_url, i) for i in range(2)]
+
+        results, stages = bulk_driver.run(urls, self.store, processes=2,
+                workers=1)
+
+        self.assertEqual([result['status'] for result in results],
+                ['ok', 'ok'], results)
+        self.assertTrue(all(result['words'] > 0 for result in results))
+
+        store = DocumentCache(CleanDocument.from_bytes, memory_size=0,
+                ttl=None, disk_path=self.store)
+
+        for url in urls:
+            doc = store.get(url)
+            self.assertIsNotNone(doc, url)
+            self.assertEqual(doc.url_type, 'epub')
+
+if __name__ == '__main__':
+    unittest.main()
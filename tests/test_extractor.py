@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of text extraction.
+
+Run from the project root with ``python -m unittest discover tests``.
+"""
+
+import os
+import sys
+import unittest
+
+from os import path
+
+APP_DIR = path.join(path.dirname(path.abspath(__file__)), os.pardir, 'app')
+
+sys.path.insert(0, APP_DIR)
+
+# The app refuses to start without a key, it's never used here
+os.environ.setdefault('READABILITY_API_KEY', 'test')
+
+from lxml import html
+
+import extractor
+
+#------------------------------------------------------------------------------
+
+# Inline markup within words, around them and next to block tags
+INLINE_SAMPLES = [
+    u'<p><span>T</span>he <em>un</em>believable <b>bold</b>ness</p>',
+    u'<div><h1>Title</h1>text after<p>para</p></div>',
+    u'<p>Hello<br/>World! <a href="#">link</a>, <i>italic</i>.</p>',
+    u'<div><p>one<!-- comment -->two</p>tail<h2>Head</h2>x</div>',
+    u'<div>a<ul><li>one</li><li>two</li></ul>b <span>c</span>d</div>',
+]
+
+def _baseline_paragraphs(content):
+    """Return paragraphs of html ``content`` split as textify used to do it:
+    with padding appended to the tail of every element and the whole tree
+    serialized to text.
+    """
+    root = html.fromstring(content)
+
+    for node in root.xpath('//*'):
+        padding = extractor._TAG_PADDING.get(node.tag.lower(), ' ')
+        node.tail = (node.tail or '') + padding
+
+    text = html.tostring(root, method='text', encoding='unicode')
+
+    return [parag for parag in extractor._regex['paragraphs'].split(text)
+            if parag.strip()]
+
+def _words(paragraphs):
+    return [parag.split() for parag in paragraphs]
+
+class RawParagraphsTest(unittest.TestCase):
+
+    def test_same_words_as_baseline(self):
+        for content in INLINE_SAMPLES:
+            paragraphs = extractor._generate_raw_paragraphs(
+                    html.fromstring(content))
+
+            self.assertEqual(_words(paragraphs),
+                    _words(_baseline_paragraphs(content)), content)
+
+    def test_inline_tags_dont_split_words(self):
+        doc = extractor.CleanDocument(None)
+        doc.content = INLINE_SAMPLES[0]
+        doc.textify()
+
+        self.assertEqual(doc.content, u'The unbelievable boldness')
+        self.assertEqual(doc.word_count, 3)
+
+if __name__ == '__main__':
+    unittest.main()